@@ -1,20 +1,28 @@
 import logging
 import sqlite3
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import re
 import os
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
-from html import escape
-from collections import defaultdict
+from collections import OrderedDict
 import io
-import psycopg2
+from psycopg2.extras import execute_batch
+from psycopg2.pool import ThreadedConnectionPool
 from urllib.parse import urlparse
 import sys
 import json
+import random
 import pytz
-from threading import Thread
+import queue
+from threading import Thread, Lock, RLock, local
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from weakref import WeakKeyDictionary
 import schedule
 
 def get_size(start_path='.'):
@@ -33,18 +41,60 @@ try:
 except ImportError:
     pass
 
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+    REPLY_MARKUP_PREFIX = b',"reply_markup":'
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+    REPLY_MARKUP_PREFIX = ',"reply_markup":'
+
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 if not BOT_TOKEN:
     logging.error("BOT_TOKEN environment variable is not set!")
     exit(1)
 
 ADMINS = [admin.strip() for admin in os.environ.get('ADMINS', 'r1kuza,nadya_yakovleva01,Priikalist').split(',') if admin.strip()]
+ADMIN_SET = frozenset(admin.lower() for admin in ADMINS)
 WEATHER_API_KEY = os.environ.get('WEATHER_API_KEY')
 SAMARA_TIMEZONE = pytz.timezone('Europe/Samara')
 
 MAX_MESSAGE_LENGTH = 4000
 MAX_USERS_PER_CLASS = 30
 MAX_REQUESTS_PER_MINUTE = 20
+MESSAGE_PAGE_LENGTH = MAX_MESSAGE_LENGTH - 200
+SAFE_MESSAGE_CACHE_LENGTH = 64
+SAFE_MESSAGE_CACHE_SIZE = 256
+HTTP_POOL_SIZE = 100
+IO_POOL_WORKERS = 4
+UPDATE_WORKERS = 4
+UPDATE_QUEUE_SIZE = 100
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+MAX_SEND_RETRIES = 3
+LONG_POLL_TIMEOUT = 50
+JSON_HEADERS = {"Content-Type": "application/json"}
+ALLOWED_UPDATES = json.dumps(["message", "callback_query"])
+DB_POOL_MIN_CONN = 2
+DB_POOL_MAX_CONN = 10
+DB_BATCH_PAGE_SIZE = 200
+SQLITE_CACHED_STATEMENTS = 256
+MAX_PROCESSED_UPDATES = 1000
+UPDATE_ID_RESET_AGE = 7 * 24 * 60 * 60
+SCHEDULE_CACHE_SIZE = 256
+EXCEL_CELL_CACHE_SIZE = 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+CACHE_TTL = 300
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;"
+    "PRAGMA synchronous=NORMAL;"
+    "PRAGMA temp_store=MEMORY;"
+    "PRAGMA cache_size=-20000;"
+    "PRAGMA mmap_size=67108864;"
+)
 
 BASE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
 
@@ -54,10 +104,327 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+SELECT_USER_SQL = "SELECT * FROM users WHERE user_id = ?"
+SELECT_USER_BY_USERNAME_SQL = "SELECT * FROM users WHERE username = ?"
+LOCK_CLASS_SQL = "SELECT pg_advisory_xact_lock(hashtext(?))"
+UPSERT_USER_SQL = "INSERT INTO users (user_id, full_name, class, username) SELECT ?, ?, ?, ? WHERE (SELECT COUNT(*) FROM users WHERE class = ?) < ? ON CONFLICT (user_id) DO UPDATE SET full_name = EXCLUDED.full_name, class = EXCLUDED.class, username = EXCLUDED.username"
+DELETE_USER_SQL = "DELETE FROM users WHERE user_id = ?"
+DELETE_USER_BY_USERNAME_SQL = "DELETE FROM users WHERE username = ?"
+DELETE_CLASS_SQL = "DELETE FROM users WHERE class = ?"
+SELECT_ALL_USERS_SQL = "SELECT user_id, full_name, class, username, registered_at FROM users ORDER BY registered_at DESC"
+SELECT_CLASS_COUNTS_SQL = "SELECT class, COUNT(*) FROM users GROUP BY class ORDER BY class"
+SELECT_SCHEDULE_SQL = "SELECT lesson_number, subject, teacher, room FROM schedule WHERE class = ? AND day = ? ORDER BY lesson_number"
+DELETE_SCHEDULE_DAY_SQL = "DELETE FROM schedule WHERE class = ? AND day = ?"
+UPSERT_LESSON_SQL = "INSERT INTO schedule (class, day, lesson_number, subject, teacher, room) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (class, day, lesson_number) DO UPDATE SET subject = EXCLUDED.subject, teacher = EXCLUDED.teacher, room = EXCLUDED.room"
+SELECT_BELLS_SQL = "SELECT lesson_number, start_time, end_time FROM bell_schedule ORDER BY lesson_number"
+UPDATE_BELL_SQL = "UPDATE bell_schedule SET start_time = ?, end_time = ? WHERE lesson_number = ?"
+PREPARED_STATEMENTS = {
+    SELECT_USER_SQL: "select_user",
+    SELECT_SCHEDULE_SQL: "select_schedule",
+}
+SELECT_BOT_STATE_SQL = "SELECT value FROM bot_state WHERE name = ?"
+UPSERT_BOT_STATE_SQL = "INSERT INTO bot_state (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value"
+
+SAFE_MESSAGE_RE = re.compile(r'<[^>]+>|[&<>"\']')
+HTML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'}
+
+DAY_NAMES = {
+    'monday': 'понедельник',
+    'tuesday': 'вторник',
+    'wednesday': 'среда',
+    'thursday': 'четверг',
+    'friday': 'пятница',
+    'saturday': 'суббота'
+}
+DAY_CODES = {name: code for code, name in DAY_NAMES.items()}
+DAY_NAME_SET = frozenset(DAY_CODES)
+DAY_NAME_MIN_LENGTH = min(map(len, DAY_NAME_SET))
+
+SHIFT_TEXTS = frozenset(["1 смена", "2 смена"])
+MAIN_MENU_CALLBACKS = frozenset(["settings_back", "achievements_back", "news_back", "stats_back"])
+
+MAIN_MENU_ACTIONS = {
+    "📚 Моё расписание": "show_my_schedule_menu",
+    "🏫 Общее расписание": "show_general_schedule_menu",
+    "🔔 Звонки": "show_bell_schedule",
+    "📰 Новости": "handle_news_menu",
+    "⚙️ Настройки": "handle_notifications_settings",
+    "🏆 Достижения": "handle_achievements_menu",
+    "📈 Статистика": "handle_statistics_menu",
+    "ℹ️ Помощь": "show_help_menu",
+}
+
+ADMIN_MENU_ACTIONS = {
+    "👥 Список пользователей": "show_users_list",
+    "❌ Удалить пользователя": "start_delete_user",
+    "📝 Редактировать расписание": "start_edit_schedule",
+    "🏫 Управление классами": "show_classes_management",
+    "🕧 Управление звонками": "show_bells_management",
+    "📤 Загрузить Excel": "start_excel_upload",
+    "📊 Статистика": "show_statistics",
+    "⬅️ Назад": "show_main_menu",
+}
+
+ADMIN_CALLBACK_ACTIONS = {
+    "admin_users": "show_users_list",
+    "admin_delete_user": "start_delete_user",
+    "admin_edit_schedule": "start_edit_schedule",
+    "admin_manage_classes": "show_classes_management",
+    "admin_bells": "show_bells_management",
+    "admin_upload_excel": "start_excel_upload",
+    "admin_stats": "show_statistics",
+    "admin_back": "close_admin_menu",
+    "admin_add_class": "start_add_class",
+    "admin_delete_class": "start_delete_class",
+    "admin_edit_bell": "start_edit_bell",
+    "admin_view_bells": "show_all_bells",
+}
+
+ADMIN_STATE_ACTIONS = {
+    "add_class_input": "handle_class_input",
+    "delete_class_input": "handle_class_input",
+    "edit_bell_number": "handle_bell_input",
+    "edit_bell_start": "handle_bell_input",
+    "edit_bell_end": "handle_bell_input",
+    "delete_user": "delete_user_by_identifier",
+    "edit_schedule_input": "handle_schedule_input",
+    "edit_schedule_class": "handle_schedule_class_selection",
+    "edit_schedule_day": "handle_schedule_day_selection",
+    "select_shift": "handle_shift_selection",
+}
+
+HELP_TEXT = (
+    "📚 <b>Школьный бот - помощь</b>\n\n"
+    "Я помогу тебе узнать расписание уроков и многое другое.\n\n"
+    "<b>Основные команды:</b>\n"
+    "• /start - начать работу\n"
+    "• /help - показать эту справку\n\n"
+    "<b>Новые возможности:</b>\n"
+    "• <b>📰 Новости</b> - школьные новости и объявления\n"
+    "• <b>⚙️ Настройки</b> - уведомления и предпочтения\n"
+    "• <b>🏆 Достижения</b> - система наград за активность\n"
+    "• <b>📈 Статистика</b> - ваша активность и прогресс\n\n"
+    "<b>Классические функции:</b>\n"
+    "• <b>Моё расписание</b> - расписание для твоего класса\n"
+    "• <b>Общее расписание</b> - расписание для любого класса\n"
+    "• <b>Звонки</b> - расписание звонков\n\n"
+    "Для регистрации просто введи свои данные в формате: Фамилия Имя, Класс\n\n"
+    "🛠 <b>Техническая помощь</b>\n"
+    "Если вы обнаружили ошибку или у вас есть предложения, "
+    "напишите разработчику: @r1kuza"
+)
+ADMIN_HELP_TEXT = HELP_TEXT + "\n\n🔐 <b>Секретная команда для админа:</b>\n/admin_panel"
+START_REGISTERED_TEXT = (
+    "Привет, {name}!\n"
+    "Ты уже зарегистрирован в системе.\n"
+    "Твой класс: {class_name}"
+)
+
+def _safe_message_replace(match):
+    return HTML_ESCAPES.get(match.group(0), '')
+
+def escape_message_text(text):
+    return SAFE_MESSAGE_RE.sub(_safe_message_replace, text)
+
+@lru_cache(maxsize=SAFE_MESSAGE_CACHE_SIZE)
+def escape_short_text(text):
+    return escape_message_text(text)
+
+TIME_RE = re.compile(r'^([0-1]?[0-9]|2[0-3]):[0-5][0-9]$')
+LESSON_LINE_RE = re.compile(r'^\s*(\d+)\s*\.\s*(.*?)\s*$')
+LESSON_NUMBER_RE = re.compile(r'\d+')
+EMPTY_CELL_VALUES = frozenset(('-', '—'))
+TEACHER_RE = re.compile(r'\((.*?)\)')
+LESSON_CELL_RE = re.compile(r'(?P<subject>(?:(?! - )[^()])*?[^()\s-])\s*(?:\((?P<teacher>[^()\n]*)\)\s*)?(?: - (?P<room>[^()]*))?')
+LESSON_INFO_RE = re.compile(r'^(?P<subject>[^(]*?)(?:\s*\(\s*(?P<teacher>[^)]*?)\s*\)(?P<after>.*?))?(?:\s+-\s+(?P<room>.*?))?\s*$')
+
+CLASS_HEADER_INITIALS = frozenset('кК')
+CLASS_HEADER_RE = re.compile(r'\d[абв]\s*$|10[пр]$|11р$|\d[абв].*класс|класс.*\d[абв]')
+CLASS_NAME_NOISE_RE = re.compile(r'(класс|смена|урок|расписание|№)')
+CLASS_NAME_RE = re.compile(r'^.*?(\d[абв])|^.*?(10[пр])|^.*?(11р)', re.S)
+
+def parse_lesson_info(lesson_info):
+    match = LESSON_INFO_RE.match(lesson_info)
+    if not match:
+        return lesson_info, "", ""
+    subject = match.group('subject') or (match.group('after') or "").strip()
+    return subject, match.group('teacher') or "", match.group('room') or ""
+
+@lru_cache(maxsize=EXCEL_CELL_CACHE_SIZE)
+def is_class_header(text):
+    text = text.strip()
+    if not text or not (text[0].isdecimal() or text[0] in CLASS_HEADER_INITIALS):
+        return False
+    return CLASS_HEADER_RE.match(text.lower()) is not None
+
+@lru_cache(maxsize=EXCEL_CELL_CACHE_SIZE)
+def extract_class_name(text):
+    text = text.lower().strip()
+    text = CLASS_NAME_NOISE_RE.sub('', text).strip()
+    match = CLASS_NAME_RE.match(text)
+    return match.group(match.lastindex).upper() if match else None
+
+@lru_cache(maxsize=EXCEL_CELL_CACHE_SIZE)
+def is_day_of_week(text):
+    text = text.strip()
+    if len(text) < DAY_NAME_MIN_LENGTH:
+        return False
+    text = text.lower()
+    return text in DAY_NAME_SET or any(day in text for day in DAY_NAME_SET)
+
+@lru_cache(maxsize=EXCEL_CELL_CACHE_SIZE)
+def parse_lesson_cell(subject):
+    if not subject or subject in EMPTY_CELL_VALUES or is_day_of_week(subject):
+        return None
+    
+    match = LESSON_CELL_RE.fullmatch(subject)
+    if match:
+        room = match.group('room')
+        return match.group('subject'), match.group('teacher') or "", room.strip() if room is not None else None
+    
+    teacher = ""
+    if '(' in subject and ')' in subject:
+        teacher_match = TEACHER_RE.search(subject)
+        if teacher_match:
+            teacher = teacher_match.group(1)
+            subject = TEACHER_RE.sub('', subject).strip()
+    
+    head, separator, room = subject.partition(' - ')
+    if separator:
+        return head.strip(), teacher, room.strip()
+    return subject, teacher, None
+
+ALL_CLASSES = tuple(f"{grade}{letter}" for grade in range(5, 10) for letter in ['А', 'Б', 'В']) + ("10П", "10Р", "11Р")
+VALID_CLASSES = frozenset(ALL_CLASSES)
+
+MAIN_MENU_KEYBOARD = {
+    "keyboard": [
+        [{"text": "📚 Моё расписание"}, {"text": "🏫 Общее расписание"}],
+        [{"text": "🔔 Звонки"}, {"text": "📰 Новости"}],
+        [{"text": "⚙️ Настройки"}, {"text": "🏆 Достижения"}],
+        [{"text": "📈 Статистика"}],
+        [{"text": "ℹ️ Помощь"}]
+    ],
+    "resize_keyboard": True
+}
+
+ADMIN_MENU_INLINE_KEYBOARD = {
+    "inline_keyboard": [
+        [{"text": "👥 Список пользователей", "callback_data": "admin_users"}],
+        [{"text": "❌ Удалить пользователя", "callback_data": "admin_delete_user"}],
+        [{"text": "📝 Редактировать расписание", "callback_data": "admin_edit_schedule"}],
+        [{"text": "🏫 Управление классами", "callback_data": "admin_manage_classes"}],
+        [{"text": "🕧 Управление звонками", "callback_data": "admin_bells"}],
+        [{"text": "📤 Загрузить Excel", "callback_data": "admin_upload_excel"}],
+        [{"text": "📢 Рассылка сообщений", "callback_data": "admin_broadcast_menu"}],
+        [{"text": "📊 Статистика", "callback_data": "admin_stats"}],
+        [{"text": "⬅️ Назад", "callback_data": "admin_back"}]
+    ]
+}
+
+CLASSES_MANAGEMENT_INLINE_KEYBOARD = {
+    "inline_keyboard": [
+        [{"text": "➕ Добавить класс", "callback_data": "admin_add_class"}],
+        [{"text": "➖ Удалить класс", "callback_data": "admin_delete_class"}],
+        [{"text": "⬅️ Назад в админку", "callback_data": "admin_back"}]
+    ]
+}
+
+BELLS_MANAGEMENT_INLINE_KEYBOARD = {
+    "inline_keyboard": [
+        [{"text": "✏️ Изменить звонок", "callback_data": "admin_edit_bell"}],
+        [{"text": "👀 Посмотреть все звонки", "callback_data": "admin_view_bells"}],
+        [{"text": "⬅️ Назад в админку", "callback_data": "admin_back"}]
+    ]
+}
+
+DAY_SELECTION_INLINE_KEYBOARD = {
+    "inline_keyboard": [
+        [{"text": "Понедельник", "callback_data": "day_monday"}],
+        [{"text": "Вторник", "callback_data": "day_tuesday"}],
+        [{"text": "Среда", "callback_data": "day_wednesday"}],
+        [{"text": "Четверг", "callback_data": "day_thursday"}],
+        [{"text": "Пятница", "callback_data": "day_friday"}],
+        [{"text": "Суббота", "callback_data": "day_saturday"}]
+    ]
+}
+
+CLASS_SELECTION_KEYBOARD = {
+    "keyboard": [
+        [{"text": cls} for cls in ALL_CLASSES[i:i + 3]]
+        for i in range(0, len(ALL_CLASSES), 3)
+    ] + [[{"text": "⬅️ Назад"}]],
+    "resize_keyboard": True
+}
+
+NOTIFICATIONS_SETTINGS_KEYBOARD = {
+    "inline_keyboard": [
+        [{"text": "🌤️ Уведомления о погоде", "callback_data": "toggle_weather"}],
+        [{"text": "📰 Новости школы", "callback_data": "toggle_news"}],
+        [{"text": "🏆 Достижения", "callback_data": "toggle_achievements"}],
+        [{"text": "⬅️ Назад", "callback_data": "settings_back"}]
+    ]
+}
+
+ACHIEVEMENTS_KEYBOARD = {
+    "inline_keyboard": [
+        [{"text": "🏆 Мои достижения", "callback_data": "my_achievements"}],
+        [{"text": "📊 Прогресс", "callback_data": "achievement_progress"}],
+        [{"text": "⬅️ Назад", "callback_data": "achievements_back"}]
+    ]
+}
+
+NEWS_KEYBOARD = {
+    "inline_keyboard": [
+        [{"text": "📰 Последние новости", "callback_data": "recent_news"}],
+        [{"text": "📊 Статистика новостей", "callback_data": "news_stats"}],
+        [{"text": "⬅️ Назад", "callback_data": "news_back"}]
+    ]
+}
+
+STATISTICS_KEYBOARD = {
+    "inline_keyboard": [
+        [{"text": "📈 Моя статистика", "callback_data": "my_statistics"}],
+        [{"text": "🏆 Достижения", "callback_data": "my_achievements"}],
+        [{"text": "⬅️ Назад", "callback_data": "stats_back"}]
+    ]
+}
+
+SHIFT_SELECTION_KEYBOARD = {
+    "keyboard": [
+        [{"text": "1 смена"}, {"text": "2 смена"}],
+        [{"text": "❌ Отменить"}]
+    ],
+    "resize_keyboard": True
+}
+
+CANCEL_KEYBOARD = {
+    "keyboard": [[{"text": "❌ Отменить"}]],
+    "resize_keyboard": True
+}
+
+MAIN_MENU_MARKUP = json_dumps(MAIN_MENU_KEYBOARD)
+ADMIN_MENU_INLINE_MARKUP = json_dumps(ADMIN_MENU_INLINE_KEYBOARD)
+CLASSES_MANAGEMENT_INLINE_MARKUP = json_dumps(CLASSES_MANAGEMENT_INLINE_KEYBOARD)
+BELLS_MANAGEMENT_INLINE_MARKUP = json_dumps(BELLS_MANAGEMENT_INLINE_KEYBOARD)
+DAY_SELECTION_INLINE_MARKUP = json_dumps(DAY_SELECTION_INLINE_KEYBOARD)
+CLASS_SELECTION_MARKUP = json_dumps(CLASS_SELECTION_KEYBOARD)
+NOTIFICATIONS_SETTINGS_MARKUP = json_dumps(NOTIFICATIONS_SETTINGS_KEYBOARD)
+ACHIEVEMENTS_MARKUP = json_dumps(ACHIEVEMENTS_KEYBOARD)
+NEWS_MARKUP = json_dumps(NEWS_KEYBOARD)
+STATISTICS_MARKUP = json_dumps(STATISTICS_KEYBOARD)
+SHIFT_SELECTION_MARKUP = json_dumps(SHIFT_SELECTION_KEYBOARD)
+CANCEL_MARKUP = json_dumps(CANCEL_KEYBOARD)
+
 class DatabaseManager:
     def __init__(self):
         self.conn = None
+        self.pool = None
         self.db_type = None
+        self.queries = {}
+        self.prepared = WeakKeyDictionary()
+        self.lock = RLock()
+        self.local = local()
         self.connect()
     
     def connect(self):
@@ -66,7 +433,9 @@ class DatabaseManager:
         if database_url:
             try:
                 url = urlparse(database_url)
-                self.conn = psycopg2.connect(
+                self.pool = ThreadedConnectionPool(
+                    DB_POOL_MIN_CONN,
+                    DB_POOL_MAX_CONN,
                     database=url.path[1:],
                     user=url.username,
                     password=url.password,
@@ -85,40 +454,118 @@ class DatabaseManager:
     def fallback_to_sqlite(self):
         try:
             db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "school_bot.db")
-            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=SQLITE_CACHED_STATEMENTS)
+            self.conn.executescript(SQLITE_PRAGMAS)
             self.db_type = 'sqlite'
             logger.info("✅ Используется SQLite база данных")
         except Exception as e:
             logger.error(f"❌ Ошибка подключения к SQLite: {e}")
             raise
     
+    def prepare(self, query):
+        prepared = self.queries.get(query)
+        if prepared is None:
+            prepared = query.replace('?', '%s') if self.db_type == 'postgresql' else query
+            self.queries[query] = prepared
+        return prepared
+    
+    def execute_prepared(self, conn, cursor, query, params):
+        name = PREPARED_STATEMENTS[query]
+        names = self.prepared.setdefault(conn, set())
+        if name not in names:
+            parts = query.split('?')
+            numbered = parts[0] + ''.join(f"${i}{part}" for i, part in enumerate(parts[1:], 1))
+            cursor.execute(f"PREPARE {name} AS {numbered}")
+            names.add(name)
+        cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    
+    @contextmanager
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            yield conn
+        elif self.pool is None:
+            with self.lock:
+                yield self.conn
+        else:
+            conn = self.pool.getconn()
+            try:
+                yield conn
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+    
     def execute(self, query, params=None):
-        if self.db_type == 'postgresql':
-            query = query.replace('?', '%s')
+        with self.connection() as conn:
+            return self.execute_on(conn, query, params)
+    
+    def execute_on(self, conn, query, params=None):
+        sql = query
+        query = self.prepare(query)
+        in_transaction = getattr(self.local, 'conn', None) is not None
         
-        cursor = self.conn.cursor()
         try:
-            if params:
-                cursor.execute(query, params)
+            if self.db_type == 'sqlite':
+                cursor = conn.execute(query, params or ())
             else:
-                cursor.execute(query)
-            self.conn.commit()
+                cursor = conn.cursor()
+                if params and sql in PREPARED_STATEMENTS:
+                    self.execute_prepared(conn, cursor, sql, params)
+                elif params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+            if not in_transaction:
+                conn.commit()
             return cursor
         except Exception as e:
-            self.conn.rollback()
+            conn.rollback()
             logger.error(f"Ошибка выполнения запроса: {e}")
             raise e
     
+    def executemany(self, query, params_seq):
+        query = self.prepare(query)
+        in_transaction = getattr(self.local, 'conn', None) is not None
+        
+        with self.connection() as conn:
+            try:
+                if self.db_type == 'sqlite':
+                    cursor = conn.executemany(query, params_seq)
+                else:
+                    cursor = conn.cursor()
+                    execute_batch(cursor, query, params_seq, page_size=DB_BATCH_PAGE_SIZE)
+                if not in_transaction:
+                    conn.commit()
+                return cursor
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Ошибка выполнения запроса: {e}")
+                raise e
+    
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            self.local.conn = conn
+            try:
+                yield
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.local.conn = None
+    
     def fetchone(self, query, params=None):
-        cursor = self.execute(query, params)
-        return cursor.fetchone()
+        with self.connection() as conn:
+            return self.execute_on(conn, query, params).fetchone()
     
     def fetchall(self, query, params=None):
-        cursor = self.execute(query, params)
-        return cursor.fetchall()
+        with self.connection() as conn:
+            return self.execute_on(conn, query, params).fetchall()
     
     def close(self):
-        if self.conn:
+        if self.pool:
+            self.pool.closeall()
+        elif self.conn:
             self.conn.close()
 
     def create_tables(self):
@@ -218,23 +665,31 @@ class DatabaseManager:
                 )
             """)
             
-            result = self.fetchone("SELECT COUNT(*) FROM bell_schedule")
-            if result and result[0] == 0:
-                bell_schedule = [
-                    (1, '8:00', '8:40'),
-                    (2, '8:50', '9:30'),
-                    (3, '9:40', '10:20'),
-                    (4, '10:30', '11:10'),
-                    (5, '11:25', '12:05'),
-                    (6, '12:10', '12:50'),
-                    (7, '13:00', '13:40')
-                ]
-                for bell in bell_schedule:
-                    self.execute(
-                        "INSERT INTO bell_schedule (lesson_number, start_time, end_time) VALUES (?, ?, ?)",
-                        bell
-                    )
-                logger.info("✅ Начальные данные для звонков созданы")
+            self.execute("CREATE INDEX IF NOT EXISTS idx_users_class ON users(class)")
+            self.execute("CREATE INDEX IF NOT EXISTS idx_users_registered_at ON users(registered_at DESC)")
+            self.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)")
+            self.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_user_action ON user_activity(user_id, action_type)")
+            
+            self.execute("""
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            """)
+            
+            bell_schedule = [
+                (1, '8:00', '8:40'),
+                (2, '8:50', '9:30'),
+                (3, '9:40', '10:20'),
+                (4, '10:30', '11:10'),
+                (5, '11:25', '12:05'),
+                (6, '12:10', '12:50'),
+                (7, '13:00', '13:40')
+            ]
+            self.executemany(
+                "INSERT INTO bell_schedule (lesson_number, start_time, end_time) VALUES (?, ?, ?) ON CONFLICT (lesson_number) DO NOTHING",
+                bell_schedule
+            )
             
             self._create_default_achievements()
             
@@ -258,34 +713,144 @@ class DatabaseManager:
             )
 
 class RateLimiter:
-    def __init__(self, max_requests=MAX_REQUESTS_PER_MINUTE, window=60):
-        self.requests = defaultdict(list)
+    def __init__(self, max_requests=MAX_REQUESTS_PER_MINUTE, window=60, sweep_interval=600):
+        self.counters = {}
+        self.lock = Lock()
         self.max_requests = max_requests
         self.window = window
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.monotonic()
     
     def is_limited(self, user_id):
-        now = time.time()
-        user_requests = self.requests[user_id]
-        user_requests = [req for req in user_requests if now - req < self.window]
-        
-        if len(user_requests) >= self.max_requests:
-            return True
-        
-        user_requests.append(now)
-        self.requests[user_id] = user_requests[-self.max_requests:]
-        return False
+        with self.lock:
+            now = time.monotonic()
+            window_index = int(now // self.window)
+            
+            if now - self.last_sweep >= self.sweep_interval:
+                self.sweep(window_index)
+                self.last_sweep = now
+            
+            counter = self.counters.get(user_id)
+            if counter is None or counter[0] < window_index - 1:
+                previous, current = 0, 0
+            elif counter[0] < window_index:
+                previous, current = counter[2], 0
+            else:
+                previous, current = counter[1], counter[2]
+            
+            weight = 1 - (now % self.window) / self.window
+            if previous * weight + current >= self.max_requests:
+                self.counters[user_id] = (window_index, previous, current)
+                return True
+            
+            self.counters[user_id] = (window_index, previous, current + 1)
+            return False
+    
+    def sweep(self, window_index):
+        idle_users = [user_id for user_id, counter in self.counters.items()
+                      if counter[0] < window_index - 1]
+        for user_id in idle_users:
+            del self.counters[user_id]
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def reserve(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+    
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class SendThrottle:
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, sweep_interval=600):
+        self.lock = Lock()
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.sweep_interval = sweep_interval
+        self.last_sweep = time.monotonic()
+    
+    def wait(self, chat_id):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_sweep >= self.sweep_interval:
+                self.sweep(now)
+                self.last_sweep = now
+            
+            chat_bucket = self.chat_buckets.get(chat_id)
+            if chat_bucket is None:
+                chat_bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            
+            delay = max(self.global_bucket.reserve(now), chat_bucket.reserve(now))
+        
+        if delay > 0:
+            time.sleep(delay)
+    
+    def sweep(self, now):
+        idle_chats = [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.is_full(now)]
+        for chat_id in idle_chats:
+            del self.chat_buckets[chat_id]
+
+class ConversationState:
+    __slots__ = ("action", "class_name", "day", "shift", "message", "lesson_number", "start_time")
+    
+    def __init__(self, action, class_name=None, day=None, shift=None, message=None, lesson_number=None, start_time=None):
+        self.action = action
+        self.class_name = class_name
+        self.day = day
+        self.shift = shift
+        self.message = message
+        self.lesson_number = lesson_number
+        self.start_time = start_time
 
 class SimpleSchoolBot:
     def __init__(self):
         self.last_update_id = 0
+        self.last_update_at = 0.0
         self.admin_states = {}
         self.user_states = {}
-        self.processed_updates = set()
+        self.processed_messages = OrderedDict()
+        self.schedule_cache = OrderedDict()
+        self.schedule_cache_lock = Lock()
+        self.bell_cache = None
+        self.bell_text_cache = None
+        self.classes_cache = None
         self.rate_limiter = RateLimiter()
+        self.send_throttle = SendThrottle()
+        self.session = self.create_session()
+        self.io_pool = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS)
+        self.import_pool = ThreadPoolExecutor(max_workers=1)
+        self.update_queues = [queue.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(UPDATE_WORKERS)]
+        self.dedup_lock = Lock()
+        self.command_handlers = {
+            "/start": lambda chat_id, user, username: self.handle_start(chat_id, user),
+            "/help": lambda chat_id, user, username: self.handle_help(chat_id, username),
+            "/admin_panel": lambda chat_id, user, username: self.handle_admin_panel(chat_id, username),
+        }
         self.db = DatabaseManager()
         
         self.init_db()
+        self.last_update_id, self.last_update_at = self.load_update_offset()
         self.setup_scheduler()
+        self.setup_update_worker()
+    
+    def create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
     
     def init_db(self):
         self.create_tables()
@@ -305,12 +870,30 @@ class SimpleSchoolBot:
         scheduler_thread = Thread(target=run_scheduler, daemon=True)
         scheduler_thread.start()
     
+    def setup_update_worker(self):
+        def run_worker(update_queue):
+            while True:
+                update = update_queue.get()
+                try:
+                    self.process_update(update)
+                finally:
+                    update_queue.task_done()
+        
+        for update_queue in self.update_queues:
+            worker_thread = Thread(target=run_worker, args=(update_queue,), daemon=True)
+            worker_thread.start()
+    
+    def dispatch_update(self, update):
+        message = update.get("message") or update.get("callback_query", {}).get("message") or {}
+        chat_id = message.get("chat", {}).get("id", 0)
+        self.update_queues[chat_id % UPDATE_WORKERS].put(update)
+    
     def start_broadcast(self, chat_id, username):
         if not self.is_admin(username):
             self.send_message(chat_id, "❌ У вас нет прав для рассылки сообщений")
             return
             
-        self.admin_states[username] = {"action": "broadcast_waiting_message"}
+        self.admin_states[username] = ConversationState("broadcast_waiting_message")
         self.send_message(
             chat_id,
             "📢 <b>Система рассылки сообений</b>\n\n"
@@ -324,14 +907,13 @@ class SimpleSchoolBot:
         )
     
     def handle_broadcast_message(self, chat_id, username, text):
-        if username not in self.admin_states:
+        state = self.admin_states.get(username)
+        if state is None:
             return
-            
-        state = self.admin_states[username]
         
-        if state.get("action") == "broadcast_waiting_message":
-            state["action"] = "broadcast_confirmation"
-            state["message"] = text
+        if state.action == "broadcast_waiting_message":
+            state.action = "broadcast_confirmation"
+            state.message = text
             
             users_count = self.db.fetchone("SELECT COUNT(*) FROM users")[0]
             
@@ -350,20 +932,20 @@ class SimpleSchoolBot:
             )
     
     def execute_broadcast(self, chat_id, username):
-        if username not in self.admin_states:
+        state = self.admin_states.get(username)
+        if state is None:
             return
             
-        state = self.admin_states[username]
-        message_text = state.get("message", "")
+        message_text = state.message or ""
         
         if not message_text:
             self.send_message(chat_id, "❌ Ошибка: сообщение не найдено")
             return
             
-        broadcast_id = self.db.execute(
+        broadcast_id = self.db.fetchone(
             "INSERT INTO broadcast_messages (admin_username, message_text, status) VALUES (?, ?, ?) RETURNING id",
             (username, message_text, 'sending')
-        ).fetchone()[0]
+        )[0]
         
         self.send_message(chat_id, "🔄 Начинаю рассылку сообщений...")
         
@@ -372,9 +954,7 @@ class SimpleSchoolBot:
         success_count = 0
         failed_count = 0
         
-        for i, user in enumerate(users):
-            user_id = user[0]
-            
+        for i, (user_id,) in enumerate(users):
             try:
                 self.send_message(user_id, message_text)
                 success_count += 1
@@ -385,8 +965,6 @@ class SimpleSchoolBot:
                         (success_count, failed_count, broadcast_id)
                     )
                 
-                time.sleep(0.1)
-                
             except Exception as e:
                 logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
                 failed_count += 1
@@ -405,8 +983,7 @@ class SimpleSchoolBot:
         
         self.send_message(chat_id, report)
         
-        if username in self.admin_states:
-            del self.admin_states[username]
+        self.admin_states.pop(username, None)
     
     def get_broadcast_history(self, chat_id):
         broadcasts = self.db.fetchall(
@@ -499,9 +1076,9 @@ class SimpleSchoolBot:
         users = self.db.fetchall(
             "SELECT user_id FROM notification_settings WHERE news_notifications = TRUE"
         )
-        for user in users:
-            message = f"📰 <b>Новая школьная новость</b>\n\n<b>{self.safe_message(title)}</b>\n\n{self.safe_message(content)}"
-            self.send_message(user[0], message)
+        message = f"📰 <b>Новая школьная новость</b>\n\n<b>{self.safe_message(title)}</b>\n\n{self.safe_message(content)}"
+        for (user_id,) in users:
+            self.send_message(user_id, message)
     
     def check_achievements(self, user_id, action_type, value=1):
         achievements = self.db.fetchall(
@@ -576,7 +1153,7 @@ class SimpleSchoolBot:
         
         try:
             url = f"http://api.weatherapi.com/v1/current.json?key={WEATHER_API_KEY}&q=Samara&lang=ru"
-            response = requests.get(url, timeout=10)
+            response = self.session.get(url, timeout=10)
             data = response.json()
             
             current = data['current']
@@ -601,8 +1178,8 @@ class SimpleSchoolBot:
         )
         weather_message = self.get_weather()
         
-        for user in users:
-            self.send_message(user[0], weather_message)
+        for (user_id,) in users:
+            self.send_message(user_id, weather_message)
     
     def log_user_activity(self, user_id, action_type, details=None):
         self.db.execute(
@@ -656,9 +1233,9 @@ class SimpleSchoolBot:
         if not text:
             return ""
         text = str(text)
-        text = re.sub(r'<[^>]+>', '', text)
-        text = escape(text)
-        return text
+        if len(text) <= SAFE_MESSAGE_CACHE_LENGTH:
+            return escape_short_text(text)
+        return escape_message_text(text)
     
     def truncate_message(self, text, max_length=MAX_MESSAGE_LENGTH):
         if len(text) <= max_length:
@@ -666,7 +1243,7 @@ class SimpleSchoolBot:
         return text[:max_length-3] + "..."
     
     def send_message(self, chat_id, text, reply_markup=None):
-        safe_text = self.truncate_message(self.safe_message(text))
+        safe_text = self.truncate_message(escape_message_text(str(text)) if text else "")
         
         url = f"{BASE_URL}/sendMessage"
         data = {
@@ -674,12 +1251,25 @@ class SimpleSchoolBot:
             "text": safe_text,
             "parse_mode": "HTML"
         }
-        if reply_markup:
+        markup_json = reply_markup if isinstance(reply_markup, (bytes, str)) else None
+        if reply_markup and markup_json is None:
             data["reply_markup"] = reply_markup
         
         try:
-            response = requests.post(url, json=data, timeout=30)
-            return response.json()
+            payload = json_dumps(data)
+            if markup_json is not None:
+                payload = payload[:-1] + REPLY_MARKUP_PREFIX + markup_json + payload[-1:]
+            for attempt in range(MAX_SEND_RETRIES + 1):
+                self.send_throttle.wait(chat_id)
+                response = self.session.post(url, data=payload, headers=JSON_HEADERS, timeout=30)
+                result = json_loads(response.content)
+                
+                if result.get("error_code") != 429 or attempt == MAX_SEND_RETRIES:
+                    return result
+                
+                retry_after = result.get("parameters", {}).get("retry_after", 1)
+                logger.warning(f"Превышен лимит Telegram для чата {chat_id}, повтор через {retry_after} с")
+                time.sleep(retry_after + random.uniform(0, 1))
         except Exception as e:
             logger.error(f"Ошибка отправки сообщения: {e}")
             return None
@@ -690,7 +1280,7 @@ class SimpleSchoolBot:
         files = {"document": (filename, document)}
         
         try:
-            response = requests.post(url, data=data, files=files, timeout=60)
+            response = self.session.post(url, data=data, files=files, timeout=60)
             return response.json()
         except Exception as e:
             logger.error(f"Ошибка отправки документа: {e}")
@@ -701,7 +1291,7 @@ class SimpleSchoolBot:
         data = {"file_id": file_id}
         
         try:
-            response = requests.post(url, json=data, timeout=30)
+            response = self.session.post(url, json=data, timeout=30)
             result = response.json()
             if result.get("ok"):
                 return result["result"]
@@ -714,10 +1304,18 @@ class SimpleSchoolBot:
         url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
         
         try:
-            response = requests.get(url, timeout=60)
-            if response.status_code == 200:
-                return response.content
-            return None
+            with self.session.get(url, timeout=60, stream=True) as response:
+                if response.status_code != 200:
+                    return None
+                
+                buffer = io.BytesIO()
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    buffer.write(chunk)
+            
+            if not buffer.tell():
+                return None
+            buffer.seek(0)
+            return buffer
         except Exception as e:
             logger.error(f"Ошибка загрузки файла: {e}")
             return None
@@ -728,14 +1326,15 @@ class SimpleSchoolBot:
     def get_updates(self):
         url = f"{BASE_URL}/getUpdates"
         params = {
-            "offset": self.last_update_id + 1,
-            "timeout": 30,
-            "limit": 100
+            "offset": self.last_update_id + 1 if time.time() - self.last_update_at < UPDATE_ID_RESET_AGE else 0,
+            "timeout": LONG_POLL_TIMEOUT,
+            "limit": 100,
+            "allowed_updates": ALLOWED_UPDATES
         }
         
         try:
-            response = requests.get(url, params=params, timeout=35)
-            result = response.json()
+            response = self.session.get(url, params=params, timeout=LONG_POLL_TIMEOUT + 10)
+            result = json_loads(response.content)
             
             if not result.get("ok") and "Conflict" in str(result.get("description", "")):
                 logger.warning("Обнаружен конфликт getUpdates")
@@ -749,19 +1348,40 @@ class SimpleSchoolBot:
             logger.error(f"Ошибка получения обновлений: {e}")
             return {"ok": False}
     
+    def load_update_offset(self):
+        try:
+            update_id = self.db.fetchone(SELECT_BOT_STATE_SQL, ("last_update_id",))
+            updated_at = self.db.fetchone(SELECT_BOT_STATE_SQL, ("last_update_at",))
+            if not update_id or not updated_at:
+                return 0, 0.0
+            return int(update_id[0]), float(updated_at[0])
+        except Exception as e:
+            logger.error(f"Ошибка загрузки offset обновлений: {e}")
+            return 0, 0.0
+    
+    def save_update_offset(self):
+        self.last_update_at = time.time()
+        try:
+            self.db.executemany(UPSERT_BOT_STATE_SQL, [
+                ("last_update_id", str(self.last_update_id)),
+                ("last_update_at", str(self.last_update_at))
+            ])
+        except Exception as e:
+            logger.error(f"Ошибка сохранения offset обновлений: {e}")
+    
     def get_user(self, user_id):
         if not self.is_valid_user_id(user_id):
             return None
             
         try:
-            return self.db.fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            return self.db.fetchone(SELECT_USER_SQL, (user_id,))
         except Exception as e:
             logger.error(f"Ошибка получения пользователя: {e}")
             return None
 
     def find_user_by_username(self, username):
         try:
-            return self.db.fetchone("SELECT * FROM users WHERE username = ?", (username,))
+            return self.db.fetchone(SELECT_USER_BY_USERNAME_SQL, (username,))
         except Exception as e:
             logger.error(f"Ошибка поиска пользователя по username: {e}")
             return None
@@ -774,17 +1394,17 @@ class SimpleSchoolBot:
             return False
             
         try:
-            result = self.db.fetchone("SELECT COUNT(*) FROM users WHERE class = ?", (class_name,))
-            count = result[0] if result else 0
-            
-            if count >= MAX_USERS_PER_CLASS:
+            with self.db.transaction():
+                if self.db.db_type == 'postgresql':
+                    self.db.execute(LOCK_CLASS_SQL, (class_name,))
+                cursor = self.db.execute(
+                    UPSERT_USER_SQL,
+                    (user_id, full_name, class_name, username, class_name, MAX_USERS_PER_CLASS)
+                )
+            if cursor.rowcount == 0:
                 self.log_security_event("class_limit_exceeded", user_id, f"Class: {class_name}")
                 return False
-            
-            self.db.execute(
-                "INSERT INTO users (user_id, full_name, class, username) VALUES (?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET full_name = EXCLUDED.full_name, class = EXCLUDED.class, username = EXCLUDED.username",
-                (user_id, full_name, class_name, username)
-            )
+            self.classes_cache = None
             return True
         except Exception as e:
             logger.error(f"Ошибка создания пользователя: {e}")
@@ -795,7 +1415,8 @@ class SimpleSchoolBot:
             return False
             
         try:
-            self.db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            self.db.execute(DELETE_USER_SQL, (user_id,))
+            self.classes_cache = None
             return True
         except Exception as e:
             logger.error(f"Ошибка удаления пользователя: {e}")
@@ -803,7 +1424,8 @@ class SimpleSchoolBot:
 
     def delete_user_by_username(self, username):
         try:
-            self.db.execute("DELETE FROM users WHERE username = ?", (username,))
+            self.db.execute(DELETE_USER_BY_USERNAME_SQL, (username,))
+            self.classes_cache = None
             return True
         except Exception as e:
             logger.error(f"Ошибка удаления пользователя по username: {e}")
@@ -811,192 +1433,124 @@ class SimpleSchoolBot:
     
     def get_all_users(self):
         try:
-            return self.db.fetchall("SELECT user_id, full_name, class, username, registered_at FROM users ORDER BY registered_at DESC")
+            return self.db.fetchall(SELECT_ALL_USERS_SQL)
         except Exception as e:
             logger.error(f"Ошибка получения пользователей: {e}")
             return []
     
+    def get_class_counts(self):
+        try:
+            return self.db.fetchall(SELECT_CLASS_COUNTS_SQL)
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики по классам: {e}")
+            return []
+    
     def get_schedule(self, class_name, day):
+        key = (class_name, day)
+        now = time.monotonic()
+        with self.schedule_cache_lock:
+            cached = self.schedule_cache.get(key)
+            if cached is not None and cached[0] > now:
+                self.schedule_cache.move_to_end(key)
+                return cached[1]
+        
         try:
-            return self.db.fetchall(
-                "SELECT lesson_number, subject, teacher, room FROM schedule WHERE class = ? AND day = ? ORDER BY lesson_number",
-                (class_name, day)
-            )
+            schedule = self.db.fetchall(SELECT_SCHEDULE_SQL, key)
         except Exception as e:
             logger.error(f"Ошибка получения расписания: {e}")
             return []
+        
+        with self.schedule_cache_lock:
+            self.schedule_cache[key] = (now + CACHE_TTL, schedule)
+            self.schedule_cache.move_to_end(key)
+            if len(self.schedule_cache) > SCHEDULE_CACHE_SIZE:
+                self.schedule_cache.popitem(last=False)
+        return schedule
     
     def save_schedule(self, class_name, day, lessons):
         try:
-            self.db.execute("DELETE FROM schedule WHERE class = ? AND day = ?", (class_name, day))
+            rows = [
+                (class_name, day, lesson_num,
+                 subject[:100] if subject else "",
+                 teacher[:50] if teacher else "",
+                 room[:20] if room else "")
+                for lesson_num, subject, teacher, room in lessons
+            ]
             
-            for lesson_num, subject, teacher, room in lessons:
-                subject = subject[:100] if subject else ""
-                teacher = teacher[:50] if teacher else ""
-                room = room[:20] if room else ""
-                
-                self.db.execute(
-                    "INSERT INTO schedule (class, day, lesson_number, subject, teacher, room) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (class, day, lesson_number) DO UPDATE SET subject = EXCLUDED.subject, teacher = EXCLUDED.teacher, room = EXCLUDED.room",
-                    (class_name, day, lesson_num, subject, teacher, room)
-                )
+            with self.db.transaction():
+                self.db.execute(DELETE_SCHEDULE_DAY_SQL, (class_name, day))
+                if rows:
+                    self.db.executemany(UPSERT_LESSON_SQL, rows)
             
+            with self.schedule_cache_lock:
+                self.schedule_cache.pop((class_name, day), None)
             return True
         except Exception as e:
             logger.error(f"Ошибка сохранения расписания: {e}")
             return False
     
     def get_bell_schedule(self):
+        now = time.monotonic()
+        if self.bell_cache is not None and self.bell_cache[0] > now:
+            return self.bell_cache[1]
+        
         try:
-            return self.db.fetchall("SELECT lesson_number, start_time, end_time FROM bell_schedule ORDER BY lesson_number")
+            bells = self.db.fetchall(SELECT_BELLS_SQL)
         except Exception as e:
             logger.error(f"Ошибка получения расписания звонков: {e}")
             return []
+        
+        self.bell_cache = (now + CACHE_TTL, bells)
+        return bells
     
     def is_admin(self, username):
-        return username and username.lower() in [admin.lower() for admin in ADMINS]
+        return bool(username) and username.lower() in ADMIN_SET
     
     def main_menu_keyboard(self):
-        return {
-            "keyboard": [
-                [{"text": "📚 Моё расписание"}, {"text": "🏫 Общее расписание"}],
-                [{"text": "🔔 Звонки"}, {"text": "📰 Новости"}],
-                [{"text": "⚙️ Настройки"}, {"text": "🏆 Достижения"}],
-                [{"text": "📈 Статистика"}],
-                [{"text": "ℹ️ Помощь"}]
-            ],
-            "resize_keyboard": True
-        }
+        return MAIN_MENU_MARKUP
     
     def admin_menu_inline_keyboard(self):
-        return {
-            "inline_keyboard": [
-                [{"text": "👥 Список пользователей", "callback_data": "admin_users"}],
-                [{"text": "❌ Удалить пользователя", "callback_data": "admin_delete_user"}],
-                [{"text": "📝 Редактировать расписание", "callback_data": "admin_edit_schedule"}],
-                [{"text": "🏫 Управление классами", "callback_data": "admin_manage_classes"}],
-                [{"text": "🕧 Управление звонками", "callback_data": "admin_bells"}],
-                [{"text": "📤 Загрузить Excel", "callback_data": "admin_upload_excel"}],
-                [{"text": "📢 Рассылка сообщений", "callback_data": "admin_broadcast_menu"}],
-                [{"text": "📊 Статистика", "callback_data": "admin_stats"}],
-                [{"text": "⬅️ Назад", "callback_data": "admin_back"}]
-            ]
-        }
+        return ADMIN_MENU_INLINE_MARKUP
     
     def notifications_settings_keyboard(self):
-        return {
-            "inline_keyboard": [
-                [{"text": "🌤️ Уведомления о погоде", "callback_data": "toggle_weather"}],
-                [{"text": "📰 Новости школы", "callback_data": "toggle_news"}],
-                [{"text": "🏆 Достижения", "callback_data": "toggle_achievements"}],
-                [{"text": "⬅️ Назад", "callback_data": "settings_back"}]
-            ]
-        }
+        return NOTIFICATIONS_SETTINGS_MARKUP
     
     def achievements_keyboard(self):
-        return {
-            "inline_keyboard": [
-                [{"text": "🏆 Мои достижения", "callback_data": "my_achievements"}],
-                [{"text": "📊 Прогресс", "callback_data": "achievement_progress"}],
-                [{"text": "⬅️ Назад", "callback_data": "achievements_back"}]
-            ]
-        }
+        return ACHIEVEMENTS_MARKUP
     
     def news_keyboard(self):
-        return {
-            "inline_keyboard": [
-                [{"text": "📰 Последние новости", "callback_data": "recent_news"}],
-                [{"text": "📊 Статистика новостей", "callback_data": "news_stats"}],
-                [{"text": "⬅️ Назад", "callback_data": "news_back"}]
-            ]
-        }
+        return NEWS_MARKUP
     
     def statistics_keyboard(self):
-        return {
-            "inline_keyboard": [
-                [{"text": "📈 Моя статистика", "callback_data": "my_statistics"}],
-                [{"text": "🏆 Достижения", "callback_data": "my_achievements"}],
-                [{"text": "⬅️ Назад", "callback_data": "stats_back"}]
-            ]
-        }
+        return STATISTICS_MARKUP
 
     def classes_management_inline_keyboard(self):
-        return {
-            "inline_keyboard": [
-                [{"text": "➕ Добавить класс", "callback_data": "admin_add_class"}],
-                [{"text": "➖ Удалить класс", "callback_data": "admin_delete_class"}],
-                [{"text": "⬅️ Назад в админку", "callback_data": "admin_back"}]
-            ]
-        }
+        return CLASSES_MANAGEMENT_INLINE_MARKUP
     
     def bells_management_inline_keyboard(self):
-        return {
-            "inline_keyboard": [
-                [{"text": "✏️ Изменить звонок", "callback_data": "admin_edit_bell"}],
-                [{"text": "👀 Посмотреть все звонки", "callback_data": "admin_view_bells"}],
-                [{"text": "⬅️ Назад в админку", "callback_data": "admin_back"}]
-            ]
-        }
+        return BELLS_MANAGEMENT_INLINE_MARKUP
     
     def day_selection_inline_keyboard(self):
-        return {
-            "inline_keyboard": [
-                [{"text": "Понедельник", "callback_data": "day_monday"}],
-                [{"text": "Вторник", "callback_data": "day_tuesday"}],
-                [{"text": "Среда", "callback_data": "day_wednesday"}],
-                [{"text": "Четверг", "callback_data": "day_thursday"}],
-                [{"text": "Пятница", "callback_data": "day_friday"}],
-                [{"text": "Суббота", "callback_data": "day_saturday"}]
-            ]
-        }
+        return DAY_SELECTION_INLINE_MARKUP
     
     def class_selection_keyboard(self):
-        classes = []
-        
-        for grade in range(5, 10):
-            for letter in ['А', 'Б', 'В']:
-                classes.append(f"{grade}{letter}")
-        
-        classes.extend(["10П", "10Р", "11Р"])
-        
-        keyboard = []
-        row = []
-        for i, cls in enumerate(classes):
-            row.append({"text": cls})
-            if (i + 1) % 3 == 0:
-                keyboard.append(row)
-                row = []
-        if row:
-            keyboard.append(row)
-        
-        keyboard.append([{"text": "⬅️ Назад"}])
-        
-        return {"keyboard": keyboard, "resize_keyboard": True}
+        return CLASS_SELECTION_MARKUP
     
     def shift_selection_keyboard(self):
-        return {
-            "keyboard": [
-                [{"text": "1 смена"}, {"text": "2 смена"}],
-                [{"text": "❌ Отменить"}]
-            ],
-            "resize_keyboard": True
-        }
+        return SHIFT_SELECTION_MARKUP
     
     def cancel_keyboard(self):
-        return {
-            "keyboard": [[{"text": "❌ Отменить"}]],
-            "resize_keyboard": True
-        }
+        return CANCEL_MARKUP
+    
+    def normalize_class(self, class_str):
+        class_name = class_str.strip()
+        if class_name in VALID_CLASSES:
+            return class_name
+        class_name = class_name.upper()
+        return class_name if class_name in VALID_CLASSES else None
     
     def is_valid_class(self, class_str):
-        class_str = class_str.strip().upper()
-        
-        if re.match(r'^[5-9][А-В]$', class_str):
-            return True
-        
-        if class_str in ['10П', '10Р', '11Р']:
-            return True
-        
-        return False
+        return self.normalize_class(class_str) is not None
     
     def is_valid_fullname(self, name):
         name = name.strip()
@@ -1014,22 +1568,30 @@ class SimpleSchoolBot:
         return True
     
     def is_valid_time(self, time_str):
-        return bool(re.match(r'^([0-1]?[0-9]|2[0-3]):[0-5][0-9]$', time_str))
+        return bool(TIME_RE.match(time_str))
     
     def get_existing_classes(self):
+        now = time.monotonic()
+        if self.classes_cache is not None and self.classes_cache[0] > now:
+            return self.classes_cache[1]
+        
         try:
             result = self.db.fetchall("SELECT DISTINCT class FROM users ORDER BY class")
-            return [row[0] for row in result]
         except Exception as e:
             logger.error(f"Ошибка получения классов: {e}")
             return []
+        
+        classes = [row[0] for row in result]
+        self.classes_cache = (now + CACHE_TTL, classes)
+        return classes
     
     def add_class(self, class_name):
         return self.is_valid_class(class_name)
     
     def delete_class(self, class_name):
         try:
-            self.db.execute("DELETE FROM users WHERE class = ?", (class_name,))
+            self.db.execute(DELETE_CLASS_SQL, (class_name,))
+            self.classes_cache = None
             return True
         except Exception as e:
             logger.error(f"Ошибка удаления класса: {e}")
@@ -1037,10 +1599,8 @@ class SimpleSchoolBot:
     
     def update_bell_schedule(self, lesson_number, start_time, end_time):
         try:
-            self.db.execute(
-                "UPDATE bell_schedule SET start_time = ?, end_time = ? WHERE lesson_number = ?",
-                (start_time, end_time, lesson_number)
-            )
+            self.db.execute(UPDATE_BELL_SQL, (start_time, end_time, lesson_number))
+            self.bell_cache = None
             return True
         except Exception as e:
             logger.error(f"Ошибка обновления расписания звонков: {e}")
@@ -1056,7 +1616,7 @@ class SimpleSchoolBot:
             logger.info("Используется метод парсинга: method3 (структурный)")
             
             try:
-                excel_file = pd.ExcelFile(io.BytesIO(file_content))
+                excel_file = pd.ExcelFile(file_content)
                 sheet_names = excel_file.sheet_names
                 logger.info(f"Доступные листы в файле: {sheet_names}")
                 
@@ -1067,7 +1627,7 @@ class SimpleSchoolBot:
                 
                 logger.info(f"Выбран лист: '{selected_sheet}'")
                 
-                df = pd.read_excel(io.BytesIO(file_content), sheet_name=selected_sheet, header=None)
+                df = excel_file.parse(sheet_name=selected_sheet, header=None)
                 logger.info(f"Размер таблицы: {df.shape} (строк: {df.shape[0]}, колонок: {df.shape[1]})")
                 
                 self._log_file_structure(df, selected_sheet)
@@ -1107,21 +1667,23 @@ class SimpleSchoolBot:
         try:
             logger.info("=== МЕТОД 3: СТРУКТУРНЫЙ ПАРСИНГ ===")
             
-            class_row_idx = self._find_class_header_row(df)
+            cells = df.to_numpy(dtype=object)
+            
+            class_row_idx = self._find_class_header_row(cells)
             if class_row_idx is None:
                 logger.error("Не удалось найти строку с заголовками классов")
                 return False
             
             logger.info(f"Найдена строка с классами: строка {class_row_idx}")
             
-            class_columns = self._extract_class_columns(df, class_row_idx)
+            class_columns = self._extract_class_columns(cells, class_row_idx)
             if not class_columns:
                 logger.error("Не удалось определить классы и их колонки")
                 return False
             
             logger.info(f"Найдены классы и колонки: {class_columns}")
             
-            day_rows = self._find_day_rows(df)
+            day_rows = self._find_day_rows(cells)
             if not day_rows:
                 logger.error("Не удалось найти дни недели")
                 return False
@@ -1137,9 +1699,9 @@ class SimpleSchoolBot:
                         next_day_idx = next_idx
                         break
                 
-                end_row = next_day_idx if next_day_idx else len(df)
+                end_row = next_day_idx if next_day_idx else len(cells)
                 
-                day_lessons = self._parse_day_schedule(df, day_row_idx, end_row, class_columns, shift, day_name)
+                day_lessons = self._parse_day_schedule(cells, day_row_idx, end_row, class_columns, shift, day_name)
                 lessons_data.extend(day_lessons)
                 logger.info(f"Для дня {day_name} найдено {len(day_lessons)} уроков")
             
@@ -1152,81 +1714,70 @@ class SimpleSchoolBot:
             logger.error(f"Трассировка: {traceback.format_exc()}")
             return False
 
-    def _find_class_header_row(self, df):
-        for i in range(min(15, len(df))):
-            row = df.iloc[i]
+    def _find_class_header_row(self, cells):
+        for i, row in enumerate(cells[:15]):
             class_count = 0
             for cell in row:
-                if pd.notna(cell) and self._is_class_header(str(cell)):
+                if pd.notna(cell) and is_class_header(str(cell)):
                     class_count += 1
             if class_count >= 2:
                 return i
         return None
 
-    def _extract_class_columns(self, df, class_row_idx):
+    def _extract_class_columns(self, cells, class_row_idx):
         class_columns = {}
-        class_row = df.iloc[class_row_idx]
+        class_row = cells[class_row_idx]
         
         for j, cell in enumerate(class_row):
             if pd.notna(cell):
                 cell_str = str(cell).strip()
-                class_name = self._extract_class_name(cell_str)
+                class_name = extract_class_name(cell_str)
                 if class_name:
                     class_columns[class_name] = j
-                    logger.debug(f"Найден класс {class_name} в колонке {j}")
+                    logger.debug("Найден класс %s в колонке %s", class_name, j)
         
         return class_columns
 
-    def _find_day_rows(self, df):
+    def _find_day_rows(self, cells):
         day_rows = []
-        day_patterns = {
-            'понедельник': 'monday',
-            'вторник': 'tuesday',
-            'среда': 'wednesday',
-            'четверг': 'thursday',
-            'пятница': 'friday',
-            'суббота': 'saturday'
-        }
+        day_codes = list(DAY_CODES.values())
         
-        for i in range(len(df)):
-            for j in range(min(3, len(df.columns))):
-                if pd.notna(df.iloc[i, j]) and isinstance(df.iloc[i, j], str):
-                    cell_value = str(df.iloc[i, j]).lower().strip()
-                    for ru_day, en_day in day_patterns.items():
-                        if ru_day in cell_value:
-                            day_rows.append((en_day, i))
-                            logger.debug(f"Найден день '{en_day}' в строке {i}, колонке {j}")
-                            break
-                    else:
-                        continue
-                    break
+        lowered = np.char.lower(cells[:, :3].astype(str))
+        matches = np.stack([np.char.find(lowered, ru_day) >= 0 for ru_day in DAY_CODES])
+        cell_hits = matches.any(axis=0)
+        
+        for i in np.flatnonzero(cell_hits.any(axis=1)):
+            j = cell_hits[i].argmax()
+            en_day = day_codes[matches[:, i, j].argmax()]
+            day_rows.append((en_day, int(i)))
+            logger.debug("Найден день '%s' в строке %s, колонке %s", en_day, i, j)
         
-        day_rows.sort(key=lambda x: x[1])
         return day_rows
 
-    def _parse_day_schedule(self, df, start_row, end_row, class_columns, shift, day_name):
+    def _parse_day_schedule(self, cells, start_row, end_row, class_columns, shift, day_name):
         lessons = []
+        block = cells[start_row:end_row]
+        present = pd.notna(block)
+        row_width = block.shape[1]
         
         lesson_numbers = {}
-        for row_idx in range(start_row, min(end_row, len(df))):
-            row = df.iloc[row_idx]
-            
-            if len(row) > 1 and pd.notna(row[1]):
-                lesson_str = str(row[1]).strip()
-                numbers = re.findall(r'\d+', lesson_str)
-                if numbers:
-                    lesson_num = int(numbers[0])
+        if row_width > 1:
+            for offset in np.flatnonzero(present[:, 1]):
+                row_idx = start_row + int(offset)
+                lesson_str = str(block[offset, 1]).strip()
+                number_match = LESSON_NUMBER_RE.search(lesson_str)
+                if number_match:
+                    lesson_num = int(number_match.group())
                     if 1 <= lesson_num <= 10:
                         lesson_numbers[row_idx] = lesson_num
-                        logger.debug(f"Найден номер урока {lesson_num} в строке {row_idx}")
+                        logger.debug("Найден номер урока %s в строке %s", lesson_num, row_idx)
         
         current_lesson_num = 1
         
-        for row_idx in range(start_row, min(end_row, len(df))):
-            row = df.iloc[row_idx]
-            
-            if all(pd.isna(cell) for cell in row):
-                continue
+        for offset in np.flatnonzero(present.any(axis=1)):
+            row_idx = start_row + int(offset)
+            row = block[offset]
+            row_present = present[offset]
             
             lesson_num = lesson_numbers.get(row_idx)
             if lesson_num is not None:
@@ -1238,30 +1789,19 @@ class SimpleSchoolBot:
             
             for class_name, col_idx in class_columns.items():
                 subject_col = col_idx
-                if subject_col < len(row) and pd.notna(row[subject_col]):
-                    subject = str(row[subject_col]).strip()
-                    
-                    if not subject or subject in ['-', '—', ''] or self._is_day_of_week(subject):
+                if subject_col < row_width and row_present[subject_col]:
+                    lesson_cell = parse_lesson_cell(str(row[subject_col]).strip())
+                    if lesson_cell is None:
                         continue
                     
-                    room = ""
-                    room_col = col_idx + 1
-                    if room_col < len(row) and pd.notna(row[room_col]):
-                        room_cell = str(row[room_col]).strip()
-                        if room_cell and not self._is_day_of_week(room_cell):
-                            room = room_cell
-                    
-                    teacher = ""
-                    if '(' in subject and ')' in subject:
-                        teacher_match = re.search(r'\((.*?)\)', subject)
-                        if teacher_match:
-                            teacher = teacher_match.group(1)
-                            subject = re.sub(r'\(.*?\)', '', subject).strip()
-                    
-                    if ' - ' in subject:
-                        room_parts = subject.split(' - ', 1)
-                        subject = room_parts[0].strip()
-                        room = room_parts[1].strip()
+                    subject, teacher, room = lesson_cell
+                    if room is None:
+                        room = ""
+                        room_col = col_idx + 1
+                        if room_col < row_width and row_present[room_col]:
+                            room_cell = str(row[room_col]).strip()
+                            if room_cell and not is_day_of_week(room_cell):
+                                room = room_cell
                     
                     if subject:
                         lessons.append({
@@ -1275,49 +1815,13 @@ class SimpleSchoolBot:
                         })
                         
                         lesson_found_in_row = True
-                        logger.debug(f"Добавлен урок: {class_name}, {day_name}, {lesson_num}, {subject}, {teacher}, {room}")
+                        logger.debug("Добавлен урок: %s, %s, %s, %s, %s, %s", class_name, day_name, lesson_num, subject, teacher, room)
             
             if lesson_found_in_row and row_idx not in lesson_numbers:
                 current_lesson_num += 1
         
         return lessons
 
-    def _is_class_header(self, text):
-        text = text.lower().strip()
-        patterns = [
-            r'^\d[абв]$',
-            r'^10[пр]$',
-            r'^11[р]$',
-            r'^\d[абв]\s*$',
-            r'^\d[абв].*класс',
-            r'^класс.*\d[абв]'
-        ]
-        return any(re.match(pattern, text) for pattern in patterns)
-
-    def _extract_class_name(self, text):
-        text = text.lower().strip()
-        
-        text = re.sub(r'(класс|смена|урок|расписание|№)', '', text).strip()
-        
-        patterns = [
-            (r'(\d[абв])', 1),
-            (r'(10[пр])', 1),
-            (r'(11[р])', 1)
-        ]
-        
-        for pattern, group in patterns:
-            match = re.search(pattern, text)
-            if match:
-                class_name = match.group(group).upper()
-                return class_name
-        
-        return None
-
-    def _is_day_of_week(self, text):
-        text = text.lower().strip()
-        days = ['понедельник', 'вторник', 'среда', 'четверг', 'пятница', 'суббота']
-        return any(day in text for day in days)
-
     def _select_sheet(self, sheet_names, shift):
         possible_sheet_names = [
             f"{shift} СМЕНА",
@@ -1364,35 +1868,71 @@ class SimpleSchoolBot:
         
         logger.info(f"Непустых ячеек в первых 20x20: {non_empty_cells}")
 
+    def run_excel_import(self, chat_id, username, file_id, import_state):
+        shift = import_state.shift
+        next_state = ConversationState("waiting_excel", shift=shift)
+        
+        try:
+            file_info = self.get_file(file_id)
+            if not file_info:
+                self.send_message(chat_id, "❌ Ошибка получения информации о файле")
+                return
+            
+            file_content = self.download_file(file_info["file_path"])
+            if not file_content:
+                self.send_message(chat_id, "❌ Ошибка загрузки файла")
+                return
+            
+            next_state = None
+            self.send_message(chat_id, f"🔍 Обрабатываю расписание для {shift} смены...")
+            
+            success, message = self.import_schedule_from_excel(file_content, shift)
+            
+            if success:
+                self.send_message(chat_id, f"✅ {message}", self.admin_menu_inline_keyboard())
+            else:
+                self.send_message(chat_id, f"❌ {message}", self.admin_menu_inline_keyboard())
+        finally:
+            if self.admin_states.get(username) is import_state:
+                if next_state is None:
+                    self.admin_states.pop(username, None)
+                else:
+                    self.admin_states[username] = next_state
+    
     def import_schedule_from_excel(self, file_content, shift):
         try:
             lessons_data = self.parse_excel_schedule(file_content, shift)
             if not lessons_data:
                 return False, f"Не удалось распарсить Excel файл для {shift} смены"
             
-            imported_count = 0
+            rows = []
             error_count = 0
+            for lesson in lessons_data:
+                lesson_number = lesson.get('lesson_number')
+                if isinstance(lesson_number, str) and lesson_number.isdigit():
+                    lesson_number = int(lesson_number)
+                if not isinstance(lesson_number, int):
+                    logger.error(f"Ошибка импорта урока {lesson}: некорректный номер урока")
+                    error_count += 1
+                    continue
+                
+                rows.append((
+                    lesson['class'], lesson['day'], lesson_number,
+                    lesson['subject'], lesson['teacher'], lesson['room']
+                ))
             
-            imported_classes = set(lesson['class'] for lesson in lessons_data)
+            imported_classes = sorted(set(lesson['class'] for lesson in lessons_data))
+            placeholders = ", ".join("?" * len(imported_classes))
             
-            for class_name in imported_classes:
-                self.db.execute("DELETE FROM schedule WHERE class = ?", (class_name,))
-                logger.info(f"Удалены старые уроки для класса {class_name}")
+            with self.db.transaction():
+                self.db.execute(f"DELETE FROM schedule WHERE class IN ({placeholders})", imported_classes)
+                if rows:
+                    self.db.executemany(UPSERT_LESSON_SQL, rows)
             
-            for lesson in lessons_data:
-                try:
-                    lesson_number = int(lesson['lesson_number'])
-                    class_name = lesson['class']
-                    day = lesson['day']
-                    
-                    self.db.execute(
-                        "INSERT INTO schedule (class, day, lesson_number, subject, teacher, room) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (class, day, lesson_number) DO UPDATE SET subject = EXCLUDED.subject, teacher = EXCLUDED.teacher, room = EXCLUDED.room",
-                        (class_name, day, lesson_number, lesson['subject'], lesson['teacher'], lesson['room'])
-                    )
-                    imported_count += 1
-                except Exception as e:
-                    logger.error(f"Ошибка импорта урока {lesson}: {e}")
-                    error_count += 1
+            logger.info(f"Обновлено расписание для классов: {', '.join(imported_classes)}")
+            with self.schedule_cache_lock:
+                self.schedule_cache.clear()
+            imported_count = len(rows)
             
             message = f"✅ Успешно импортировано {imported_count} уроков для {shift} смены"
             if error_count > 0:
@@ -1407,17 +1947,16 @@ class SimpleSchoolBot:
         user_data = self.get_user(user["id"])
         
         if user_data:
-            text = (
-                f"Привет, {self.safe_message(user.get('first_name', 'друг'))}!\n"
-                f"Ты уже зарегистрирован в системе.\n"
-                f"Твой класс: {self.safe_message(user_data[2])}"
+            text = START_REGISTERED_TEXT.format(
+                name=self.safe_message(user.get('first_name', 'друг')),
+                class_name=user_data[2]
             )
             self.send_message(chat_id, text, self.main_menu_keyboard())
         else:
             self.handle_registration_start(chat_id, user["id"])
     
     def handle_registration_start(self, chat_id, user_id):
-        self.user_states[user_id] = {"action": "registration"}
+        self.user_states[user_id] = ConversationState("registration")
         self.send_message(
             chat_id,
             "👋 <b>Добро пожаловать в школьный бот!</b>\n\n"
@@ -1428,31 +1967,7 @@ class SimpleSchoolBot:
         )
     
     def handle_help(self, chat_id, username):
-        text = (
-            "📚 <b>Школьный бот - помощь</b>\n\n"
-            "Я помогу тебе узнать расписание уроков и многое другое.\n\n"
-            "<b>Основные команды:</b>\n"
-            "• /start - начать работу\n"
-            "• /help - показать эту справку\n\n"
-            "<b>Новые возможности:</b>\n"
-            "• <b>📰 Новости</b> - школьные новости и объявления\n"
-            "• <b>⚙️ Настройки</b> - уведомления и предпочтения\n"
-            "• <b>🏆 Достижения</b> - система наград за активность\n"
-            "• <b>📈 Статистика</b> - ваша активность и прогресс\n\n"
-            "<b>Классические функции:</b>\n"
-            "• <b>Моё расписание</b> - расписание для твоего класса\n"
-            "• <b>Общее расписание</b> - расписание для любого класса\n"
-            "• <b>Звонки</b> - расписание звонков\n\n"
-            "Для регистрации просто введи свои данные в формате: Фамилия Имя, Класс\n\n"
-            "🛠 <b>Техническая помощь</b>\n"
-            "Если вы обнаружили ошибку или у вас есть предложения, "
-            "напишите разработчику: @r1kuza"
-        )
-        
-        if self.is_admin(username):
-            text += "\n\n🔐 <b>Секретная команда для админа:</b>\n/admin_panel"
-        
-        self.send_message(chat_id, text)
+        self.send_message(chat_id, ADMIN_HELP_TEXT if self.is_admin(username) else HELP_TEXT)
     
     def handle_admin_panel(self, chat_id, username):
         if not self.is_admin(username):
@@ -1476,6 +1991,8 @@ class SimpleSchoolBot:
         
         logger.info(f"Callback received: {data} from user {username}")
         
+        self.answer_callback_query(callback_query["id"])
+        
         if data == "admin_broadcast_menu":
             self.handle_broadcast_menu(chat_id, username)
         elif data == "admin_broadcast":
@@ -1485,8 +2002,7 @@ class SimpleSchoolBot:
         elif data == "broadcast_confirm":
             self.execute_broadcast(chat_id, username)
         elif data == "broadcast_cancel":
-            if username in self.admin_states:
-                del self.admin_states[username]
+            self.admin_states.pop(username, None)
             self.send_message(chat_id, "❌ Рассылка отменена", self.admin_menu_inline_keyboard())
         
         elif data.startswith("toggle_"):
@@ -1501,30 +2017,21 @@ class SimpleSchoolBot:
             self.show_news_statistics(chat_id, user_id)
         elif data == "my_statistics":
             self.show_detailed_statistics(chat_id, user_id)
-        elif data in ["settings_back", "achievements_back", "news_back", "stats_back"]:
+        elif data in MAIN_MENU_CALLBACKS:
             self.send_message(chat_id, "Главное меню", self.main_menu_keyboard())
         
         elif data.startswith("day_"):
             day_code = data[4:]
-            day_map = {
-                'monday': 'понедельник',
-                'tuesday': 'вторник', 
-                'wednesday': 'среда',
-                'thursday': 'четверг',
-                'friday': 'пятница',
-                'saturday': 'суббота'
-            }
-            day_text = day_map.get(day_code, day_code)
+            day_text = DAY_NAMES.get(day_code, day_code)
             
-            if username in self.admin_states and self.admin_states[username].get("action") == "edit_schedule_day":
+            admin_state = self.admin_states.get(username)
+            if admin_state is not None and admin_state.action == "edit_schedule_day":
                 self.handle_schedule_day_selection(chat_id, username, day_text)
             else:
                 self.handle_day_selection(chat_id, user_id, day_text)
             
         elif data.startswith("admin_"):
             self.handle_admin_callback(chat_id, username, data)
-            
-        self.answer_callback_query(callback_query["id"])
     
     def handle_broadcast_menu(self, chat_id, username):
         if not self.is_admin(username):
@@ -1543,59 +2050,30 @@ class SimpleSchoolBot:
             self.send_message(chat_id, "❌ У вас нет доступа к админ-панели")
             return
         
-        if data == "admin_users":
-            self.show_users_list(chat_id)
-        elif data == "admin_delete_user":
-            self.start_delete_user(chat_id, username)
-        elif data == "admin_edit_schedule":
-            self.start_edit_schedule(chat_id, username)
-        elif data == "admin_manage_classes":
-            self.show_classes_management(chat_id, username)
-        elif data == "admin_bells":
-            self.show_bells_management(chat_id, username)
-        elif data == "admin_upload_excel":
-            self.send_message(
-                chat_id,
-                "📤 <b>Загрузка расписания из Excel</b>\n\n"
-                "Выберите смену для загрузки:",
-                self.shift_selection_keyboard()
-            )
-            self.admin_states[username] = {"action": "select_shift"}
-        elif data == "admin_stats":
-            self.show_statistics(chat_id)
-        elif data == "admin_back":
-            if username in self.admin_states:
-                del self.admin_states[username]
-            self.send_message(chat_id, "Главное меню", self.main_menu_keyboard())
-        elif data == "admin_add_class":
-            self.start_add_class(chat_id, username)
-        elif data == "admin_delete_class":
-            self.start_delete_class(chat_id, username)
-        elif data == "admin_edit_bell":
-            self.start_edit_bell(chat_id, username)
-        elif data == "admin_view_bells":
-            self.show_all_bells(chat_id)
+        action = ADMIN_CALLBACK_ACTIONS.get(data)
+        if action:
+            getattr(self, action)(chat_id, username)
+    
+    def close_admin_menu(self, chat_id, username):
+        self.admin_states.pop(username, None)
+        self.show_main_menu(chat_id, username)
     
     def handle_text_message(self, chat_id, user_id, username, text):
         if text == "❌ Отменить":
-            if username in self.admin_states:
-                del self.admin_states[username]
-            if user_id in self.user_states:
-                del self.user_states[user_id]
+            self.admin_states.pop(username, None)
+            self.user_states.pop(user_id, None)
             self.send_message(chat_id, "Действие отменено", self.main_menu_keyboard())
             return
         
-        if username in self.admin_states:
-            state = self.admin_states[username]
-            if state.get("action") == "broadcast_waiting_message":
-                self.handle_broadcast_message(chat_id, username, text)
-                return
+        state = self.admin_states.get(username)
+        if state is not None and state.action == "broadcast_waiting_message":
+            self.handle_broadcast_message(chat_id, username, text)
+            return
         
-        if user_id in self.user_states:
-            state = self.user_states[user_id]
-            if state.get("action") == "registration":
-                self.handle_registration_input(chat_id, user_id, username, text)
-                return
+        state = self.user_states.get(user_id)
+        if state is not None and state.action == "registration":
+            self.handle_registration_input(chat_id, user_id, username, text)
+            return
         
         user_data = self.get_user(user_id)
         if user_data:
@@ -1604,19 +2082,19 @@ class SimpleSchoolBot:
             self.handle_registration_start(chat_id, user_id)
     
     def handle_registration_input(self, chat_id, user_id, username, text):
-        parts = text.split(',')
-        if len(parts) != 2:
+        full_name, separator, class_part = text.partition(',')
+        if not separator or ',' in class_part:
             self.send_message(chat_id, "❌ Неверный формат. Введите: Фамилия Имя, Класс")
             return
         
-        full_name = parts[0].strip()
-        class_name = parts[1].strip().upper()
+        full_name = full_name.strip()
+        class_name = self.normalize_class(class_part)
         
         if not self.is_valid_fullname(full_name):
             self.send_message(chat_id, "❌ Неверный формат ФИО")
             return
         
-        if not self.is_valid_class(class_name):
+        if class_name is None:
             self.send_message(chat_id, "❌ Неверный формат класса")
             return
         
@@ -1634,8 +2112,7 @@ class SimpleSchoolBot:
         else:
             self.send_message(chat_id, "❌ Ошибка регистрации", self.main_menu_keyboard())
         
-        if user_id in self.user_states:
-            del self.user_states[user_id]
+        self.user_states.pop(user_id, None)
 
     def show_classes_management(self, chat_id, username):
         text = "🏫 <b>Управление классами</b>\n\nВыберите действие:"
@@ -1646,7 +2123,7 @@ class SimpleSchoolBot:
         self.send_message(chat_id, text, self.bells_management_inline_keyboard())
     
     def start_add_class(self, chat_id, username):
-        self.admin_states[username] = {"action": "add_class_input"}
+        self.admin_states[username] = ConversationState("add_class_input")
         self.send_message(
             chat_id,
             "Введите название класса для добавления:\n\n"
@@ -1656,7 +2133,7 @@ class SimpleSchoolBot:
         )
     
     def start_delete_class(self, chat_id, username):
-        self.admin_states[username] = {"action": "delete_class_input"}
+        self.admin_states[username] = ConversationState("delete_class_input")
         
         classes = self.get_existing_classes()
         classes_text = "Существующие классы:\n" + "\n".join(classes) if classes else "❌ Нет зарегистрированных классов"
@@ -1668,30 +2145,31 @@ class SimpleSchoolBot:
         )
     
     def start_edit_bell(self, chat_id, username):
-        self.admin_states[username] = {"action": "edit_bell_number"}
+        self.admin_states[username] = ConversationState("edit_bell_number")
         self.send_message(
             chat_id,
             "Введите номер урока для изменения (1-7):",
             self.cancel_keyboard()
         )
     
-    def show_all_bells(self, chat_id):
+    def show_all_bells(self, chat_id, username=None):
         bells = self.get_bell_schedule()
         bells_text = "🔔 <b>Текущее расписание звонков</b>\n\n"
-        for bell in bells:
-            bells_text += f"{bell[0]}. {bell[1]} - {bell[2]}\n"
+        for lesson_number, start_time, end_time in bells:
+            bells_text += f"{lesson_number}. {start_time} - {end_time}\n"
         self.send_message(chat_id, bells_text)
     
     def handle_class_input(self, chat_id, username, text):
-        if username not in self.admin_states:
+        state = self.admin_states.get(username)
+        if state is None:
             return
         
-        action = self.admin_states[username].get("action")
-        class_name = text.strip().upper()
+        action = state.action
+        class_name = self.normalize_class(text)
         
-        if not self.is_valid_class(class_name):
+        if class_name is None:
             self.send_message(chat_id, "❌ Неверный формат класса", self.admin_menu_inline_keyboard())
-            del self.admin_states[username]
+            self.admin_states.pop(username, None)
             return
         
         if action == "add_class_input":
@@ -1705,41 +2183,40 @@ class SimpleSchoolBot:
             else:
                 self.send_message(chat_id, f"❌ Класс {class_name} не найден или в нем нет пользователей", self.admin_menu_inline_keyboard())
         
-        del self.admin_states[username]
+        self.admin_states.pop(username, None)
     
     def handle_bell_input(self, chat_id, username, text):
-        if username not in self.admin_states:
+        state = self.admin_states.get(username)
+        if state is None:
             return
         
-        state = self.admin_states[username]
-        
-        if state.get("action") == "edit_bell_number":
+        if state.action == "edit_bell_number":
             try:
                 lesson_number = int(text)
                 if 1 <= lesson_number <= 7:
-                    state["action"] = "edit_bell_start"
-                    state["lesson_number"] = lesson_number
+                    state.action = "edit_bell_start"
+                    state.lesson_number = lesson_number
                     self.send_message(chat_id, f"Урок {lesson_number}. Введите время начала (формат ЧЧ:ММ):", self.cancel_keyboard())
                 else:
                     self.send_message(chat_id, "❌ Номер урока должен быть от 1 до 7", self.bells_management_inline_keyboard())
-                    del self.admin_states[username]
+                    self.admin_states.pop(username, None)
             except ValueError:
                 self.send_message(chat_id, "❌ Введите число от 1 до 7", self.bells_management_inline_keyboard())
-                del self.admin_states[username]
+                self.admin_states.pop(username, None)
         
-        elif state.get("action") == "edit_bell_start":
+        elif state.action == "edit_bell_start":
             if self.is_valid_time(text):
-                state["action"] = "edit_bell_end"
-                state["start_time"] = text
+                state.action = "edit_bell_end"
+                state.start_time = text
                 self.send_message(chat_id, f"Введите время окончания (формат ЧЧ:ММ):", self.cancel_keyboard())
             else:
                 self.send_message(chat_id, "❌ Неверный формат времени. Используйте ЧЧ:ММ", self.bells_management_inline_keyboard())
-                del self.admin_states[username]
+                self.admin_states.pop(username, None)
         
-        elif state.get("action") == "edit_bell_end":
+        elif state.action == "edit_bell_end":
             if self.is_valid_time(text):
-                lesson_number = state["lesson_number"]
-                start_time = state["start_time"]
+                lesson_number = state.lesson_number
+                start_time = state.start_time
                 end_time = text
                 
                 if self.update_bell_schedule(lesson_number, start_time, end_time):
@@ -1747,78 +2224,74 @@ class SimpleSchoolBot:
                 else:
                     self.send_message(chat_id, f"❌ Ошибка обновления звонка", self.bells_management_inline_keyboard())
                 
-                del self.admin_states[username]
+                self.admin_states.pop(username, None)
             else:
                 self.send_message(chat_id, "❌ Неверный формат времени. Используйте ЧЧ:ММ", self.bells_management_inline_keyboard())
-                del self.admin_states[username]
+                self.admin_states.pop(username, None)
     
     def handle_main_menu(self, chat_id, user_id, text, username):
-        user_data = self.get_user(user_id)
+        action = MAIN_MENU_ACTIONS.get(text)
         
-        if text == "📚 Моё расписание":
-            if not user_data:
-                self.send_message(
-                    chat_id,
-                    "❌ Вы не зарегистрированы. Пожалуйста, введите свои данные в формате: Фамилия Имя, Класс"
-                )
-                return
-            
-            class_name = user_data[2]
-            self.user_states[user_id] = {"action": "my_schedule", "class": class_name}
-            self.send_message(
-                chat_id,
-                f"Выберите день недели для расписания {self.safe_message(class_name)} класса:",
-                self.day_selection_inline_keyboard()
-            )
-            self.log_user_activity(user_id, "schedule_view", f"Class: {class_name}")
-        
-        elif text == "🏫 Общее расписание":
-            self.user_states[user_id] = {"action": "general_schedule"}
-            self.send_message(
-                chat_id,
-                "Выберите класс:",
-                self.class_selection_keyboard()
-            )
-        
-        elif text == "🔔 Звонки":
-            bells = self.get_bell_schedule()
-            bells_text = "🔔 <b>Расписание звонков</b>\n\n"
-            for bell in bells:
-                bells_text += f"{bell[0]}. {bell[1]} - {bell[2]}\n"
-                if bell[0] == 4:
-                    bells_text += "    ⏰ Перемена 15 минут\n"
-                elif bell[0] == 5:
-                    bells_text += "    ⏰ Перемена 5 минут\n"
-                elif bell[0] < 7:
-                    bells_text += "    ⏰ Перемена 10 минут\n"
-            
-            bells_text += "\n📝 Уроки по 40 минут"
-            self.send_message(chat_id, bells_text)
-        
-        elif text == "📰 Новости":
-            self.handle_news_menu(chat_id, user_id)
-        
-        elif text == "⚙️ Настройки":
-            self.handle_notifications_settings(chat_id, user_id)
-        
-        elif text == "🏆 Достижения":
-            self.handle_achievements_menu(chat_id, user_id)
-        
-        elif text == "📈 Статистика":
-            self.handle_statistics_menu(chat_id, user_id)
-        
-        elif text == "ℹ️ Помощь":
-            self.handle_help(chat_id, username)
+        if action:
+            getattr(self, action)(chat_id, user_id, username)
         
         elif text == "⬅️ Назад":
-            if user_id in self.user_states:
-                del self.user_states[user_id]
+            self.user_states.pop(user_id, None)
             self.send_message(chat_id, "Главное меню", self.main_menu_keyboard())
         
         elif self.is_valid_class(text):
             self.handle_class_selection(chat_id, user_id, text)
     
-    def handle_notifications_settings(self, chat_id, user_id):
+    def show_my_schedule_menu(self, chat_id, user_id, username):
+        user_data = self.get_user(user_id)
+        if not user_data:
+            self.send_message(
+                chat_id,
+                "❌ Вы не зарегистрированы. Пожалуйста, введите свои данные в формате: Фамилия Имя, Класс"
+            )
+            return
+        
+        class_name = user_data[2]
+        self.user_states[user_id] = ConversationState("my_schedule", class_name=class_name)
+        self.send_message(
+            chat_id,
+            f"Выберите день недели для расписания {class_name} класса:",
+            self.day_selection_inline_keyboard()
+        )
+        self.log_user_activity(user_id, "schedule_view", f"Class: {class_name}")
+    
+    def show_general_schedule_menu(self, chat_id, user_id, username):
+        self.user_states[user_id] = ConversationState("general_schedule")
+        self.send_message(
+            chat_id,
+            "Выберите класс:",
+            self.class_selection_keyboard()
+        )
+    
+    def show_bell_schedule(self, chat_id, user_id, username):
+        bells = self.get_bell_schedule()
+        if self.bell_text_cache is not None and self.bell_text_cache[0] is bells:
+            self.send_message(chat_id, self.bell_text_cache[1])
+            return
+        
+        bells_text = "🔔 <b>Расписание звонков</b>\n\n"
+        for lesson_number, start_time, end_time in bells:
+            bells_text += f"{lesson_number}. {start_time} - {end_time}\n"
+            if lesson_number == 4:
+                bells_text += "    ⏰ Перемена 15 минут\n"
+            elif lesson_number == 5:
+                bells_text += "    ⏰ Перемена 5 минут\n"
+            elif lesson_number < 7:
+                bells_text += "    ⏰ Перемена 10 минут\n"
+        
+        bells_text += "\n📝 Уроки по 40 минут"
+        self.bell_text_cache = (bells, bells_text)
+        self.send_message(chat_id, bells_text)
+    
+    def show_help_menu(self, chat_id, user_id, username):
+        self.handle_help(chat_id, username)
+    
+    def handle_notifications_settings(self, chat_id, user_id, username=None):
         settings = self.get_notification_settings(user_id)
         
         weather_status = "✅ ВКЛ" if settings['weather_notifications'] else "❌ ВЫКЛ"
@@ -1833,7 +2306,7 @@ class SimpleSchoolBot:
         
         self.send_message(chat_id, text, self.notifications_settings_keyboard())
     
-    def handle_achievements_menu(self, chat_id, user_id):
+    def handle_achievements_menu(self, chat_id, user_id, username=None):
         achievements = self.get_user_achievements(user_id)
         text = "🏆 <b>Система достижений</b>\n\n"
         
@@ -1846,7 +2319,7 @@ class SimpleSchoolBot:
         
         self.send_message(chat_id, text, self.achievements_keyboard())
     
-    def handle_news_menu(self, chat_id, user_id):
+    def handle_news_menu(self, chat_id, user_id, username=None):
         news_count = self.db.fetchone("SELECT COUNT(*) FROM school_news WHERE is_published = TRUE")
         news_count = news_count[0] if news_count else 0
         user_news_read = self.get_user_statistics(user_id)['news_read']
@@ -1858,7 +2331,7 @@ class SimpleSchoolBot:
         
         self.send_message(chat_id, text, self.news_keyboard())
     
-    def handle_statistics_menu(self, chat_id, user_id):
+    def handle_statistics_menu(self, chat_id, user_id, username=None):
         stats = self.get_user_statistics(user_id)
         achievements = len(self.get_user_achievements(user_id))
         
@@ -1930,11 +2403,12 @@ class SimpleSchoolBot:
             return
         
         text = "📰 <b>Последние новости</b>\n\n"
+        esc = self.safe_message
         for title, content, author, publish_date in news:
             date_str = self.format_date(publish_date)
-            text += f"<b>{self.safe_message(title)}</b>\n"
-            text += f"{self.safe_message(content[:100])}...\n"
-            text += f"👤 {self.safe_message(author)} | 📅 {date_str}\n\n"
+            text += f"<b>{esc(title)}</b>\n"
+            text += f"{esc(content[:100])}...\n"
+            text += f"👤 {esc(author)} | 📅 {date_str}\n\n"
             
             self.log_user_activity(user_id, "news_read", f"News: {title}")
         
@@ -1967,11 +2441,15 @@ class SimpleSchoolBot:
         stats = self.get_user_statistics(user_id)
         achievements = self.get_user_achievements(user_id)
         user_data = self.get_user(user_id)
+        if user_data:
+            full_name, class_name = self.safe_message(user_data[1]), user_data[2]
+        else:
+            full_name = class_name = 'Неизвестно'
         
         text = (f"📈 <b>Подробная статистика</b>\n\n"
                f"👤 <b>Профиль</b>\n"
-               f"• Имя: {self.safe_message(user_data[1]) if user_data else 'Неизвестно'}\n"
-               f"• Класс: {self.safe_message(user_data[2]) if user_data else 'Неизвестно'}\n\n"
+               f"• Имя: {full_name}\n"
+               f"• Класс: {class_name}\n\n"
                
                f"📊 <b>Активность</b>\n"
                f"• Всего действий: {stats['total_actions']}\n"
@@ -1988,7 +2466,7 @@ class SimpleSchoolBot:
         self.send_message(chat_id, text, self.statistics_keyboard())
     
     def start_delete_user(self, chat_id, username):
-        self.admin_states[username] = {"action": "delete_user"}
+        self.admin_states[username] = ConversationState("delete_user")
         self.send_message(
             chat_id,
             "Введите ID пользователя или username для удаления:\n\n"
@@ -2019,53 +2497,46 @@ class SimpleSchoolBot:
         except ValueError:
             self.send_message(chat_id, "❌ Неверный формат ID", self.admin_menu_inline_keyboard())
         
-        if admin_username in self.admin_states:
-            del self.admin_states[admin_username]
+        self.admin_states.pop(admin_username, None)
 
     def answer_callback_query(self, callback_query_id, text=None):
+        return self.io_pool.submit(self.post_callback_answer, callback_query_id, text)
+    
+    def post_callback_answer(self, callback_query_id, text=None):
         url = f"{BASE_URL}/answerCallbackQuery"
         data = {"callback_query_id": callback_query_id}
         if text:
             data["text"] = text
         
         try:
-            response = requests.post(url, json=data, timeout=10)
+            response = self.session.post(url, json=data, timeout=10)
             return response.json()
         except Exception as e:
             logger.error(f"Ошибка ответа на callback: {e}")
             return None
     
     def handle_day_selection(self, chat_id, user_id, day_text):
-        if user_id not in self.user_states:
+        state = self.user_states.get(user_id)
+        if state is None:
             logger.error(f"User state not found for user {user_id}")
             self.send_message(chat_id, "❌ Ошибка: действие не найдено", self.main_menu_keyboard())
             return
         
-        state = self.user_states[user_id]
-        day_map = {
-            'понедельник': 'monday',
-            'вторник': 'tuesday',
-            'среда': 'wednesday',
-            'четверг': 'thursday',
-            'пятница': 'friday',
-            'суббота': 'saturday'
-        }
-        
-        day_code = day_map.get(day_text.lower())
+        day_code = DAY_CODES.get(day_text.lower())
         if not day_code:
             self.send_message(chat_id, "❌ Неверный день недели", self.main_menu_keyboard())
             return
         
-        if state.get("action") == "my_schedule":
-            class_name = state.get("class")
+        if state.action == "my_schedule":
+            class_name = state.class_name
             if not class_name:
                 self.send_message(chat_id, "❌ Ошибка: класс не найден", self.main_menu_keyboard())
                 return
             
             self.show_schedule(chat_id, class_name, day_code, day_text)
         
-        elif state.get("action") == "general_schedule":
-            class_name = state.get("selected_class")
+        elif state.action == "general_schedule":
+            class_name = state.class_name
             if not class_name:
                 self.send_message(chat_id, "❌ Ошибка: класс не выбран", self.main_menu_keyboard())
                 return
@@ -2073,37 +2544,37 @@ class SimpleSchoolBot:
             self.show_schedule(chat_id, class_name, day_code, day_text)
     
     def handle_class_selection(self, chat_id, user_id, class_name):
-        if user_id not in self.user_states:
+        state = self.user_states.get(user_id)
+        if state is None:
             self.send_message(chat_id, "❌ Ошибка: действие не найдено", self.main_menu_keyboard())
             return
         
-        state = self.user_states[user_id]
-        
-        if state.get("action") == "general_schedule":
-            self.user_states[user_id] = {
-                "action": "general_schedule",
-                "selected_class": class_name
-            }
+        if state.action == "general_schedule":
+            self.user_states[user_id] = ConversationState("general_schedule", class_name=class_name)
             self.send_message(
                 chat_id,
                 f"Выбран класс: {class_name}\nТеперь выберите день недели:",
                 self.day_selection_inline_keyboard()
             )
     
+    def format_lesson(self, lesson, bold=False):
+        lesson_number, subject, teacher, room = lesson
+        esc = self.safe_message
+        line = f"{lesson_number}. <b>{esc(subject)}</b>" if bold else f"{lesson_number}. {esc(subject)}"
+        if teacher:
+            line += f" ({esc(teacher)})"
+        if room:
+            line += f" - {esc(room)}"
+        return line
+    
     def show_schedule(self, chat_id, class_name, day_code, day_name):
         schedule = self.get_schedule(class_name, day_code)
         
         if schedule:
-            schedule_text = f"📅 <b>Расписание {self.safe_message(class_name)} класса</b>\n{day_name}\n\n"
-            for lesson in schedule:
-                schedule_text += f"{lesson[0]}. <b>{self.safe_message(lesson[1])}</b>"
-                if lesson[2]:
-                    schedule_text += f" ({self.safe_message(lesson[2])})"
-                if lesson[3]:
-                    schedule_text += f" - {self.safe_message(lesson[3])}"
-                schedule_text += "\n"
+            lessons = "\n".join(self.format_lesson(lesson, bold=True) for lesson in schedule)
+            schedule_text = f"📅 <b>Расписание {class_name} класса</b>\n{day_name}\n\n{lessons}\n"
         else:
-            schedule_text = f"❌ Расписание для {self.safe_message(class_name)} класса на {day_name.lower()} не найдено"
+            schedule_text = f"❌ Расписание для {class_name} класса на {day_name.lower()} не найдено"
         
         self.send_message(chat_id, schedule_text, self.main_menu_keyboard())
     
@@ -2113,37 +2584,30 @@ class SimpleSchoolBot:
             self.send_message(chat_id, "❌ У вас нет доступа к этой функции")
             return
         
-        if text == "👥 Список пользователей":
-            self.show_users_list(chat_id)
-        elif text == "❌ Удалить пользователя":
-            self.start_delete_user(chat_id, username)
-        elif text == "📝 Редактировать расписание":
-            self.start_edit_schedule(chat_id, username)
-        elif text == "🏫 Управление классами":
-            self.show_classes_management(chat_id, username)
-        elif text == "🕧 Управление звонками":
-            self.show_bells_management(chat_id, username)
-        elif text == "📤 Загрузить Excel":
-            self.send_message(
-                chat_id,
-                "📤 <b>Загрузка расписания из Excel</b>\n\n"
-                "Выберите смену для загрузки:",
-                self.shift_selection_keyboard()
-            )
-            self.admin_states[username] = {"action": "select_shift"}
-        elif text == "📊 Статистика":
-            self.show_statistics(chat_id)
-        elif text == "⬅️ Назад":
-            self.send_message(chat_id, "Главное меню", self.main_menu_keyboard())
-        elif text in ["1 смена", "2 смена"]:
+        action = ADMIN_MENU_ACTIONS.get(text)
+        if action:
+            getattr(self, action)(chat_id, username)
+        elif text in SHIFT_TEXTS:
             self.handle_shift_selection(chat_id, username, text)
     
+    def start_excel_upload(self, chat_id, username):
+        self.send_message(
+            chat_id,
+            "📤 <b>Загрузка расписания из Excel</b>\n\n"
+            "Выберите смену для загрузки:",
+            self.shift_selection_keyboard()
+        )
+        self.admin_states[username] = ConversationState("select_shift")
+    
+    def show_main_menu(self, chat_id, username):
+        self.send_message(chat_id, "Главное меню", self.main_menu_keyboard())
+    
     def handle_shift_selection(self, chat_id, username, shift_text):
         if username not in self.admin_states:
             return
         
         shift = "1" if shift_text == "1 смена" else "2"
-        self.admin_states[username] = {"action": "waiting_excel", "shift": shift}
+        self.admin_states[username] = ConversationState("waiting_excel", shift=shift)
         
         self.send_message(
             chat_id,
@@ -2153,26 +2617,34 @@ class SimpleSchoolBot:
             self.cancel_keyboard()
         )
     
-    def show_users_list(self, chat_id):
+    def show_users_list(self, chat_id, username=None):
         users = self.get_all_users()
-        
         if not users:
             self.send_message(chat_id, "❌ Нет зарегистрированных пользователей")
             return
         
-        users_text = "👥 <b>Список пользователей</b>\n\n"
-        for user in users:
-            reg_date_str = self.format_date(user[4])
-            username_display = f" (@{user[3]})" if user[3] else ""
-                
-            users_text += f"👤 {self.safe_message(user[1])}{username_display}\n"
-            users_text += f"   Класс: {self.safe_message(user[2])} | ID: {user[0]}\n"
-            users_text += f"   📅 Зарегистрирован: {reg_date_str}\n\n"
+        page = ["👥 <b>Список пользователей</b>\n\n"]
+        page_length = len(page[0])
+        for user_id, full_name, class_name, nickname, registered_at in users:
+            reg_date_str = self.format_date(registered_at)
+            username_display = f" (@{nickname})" if nickname else ""
+            
+            entry = (
+                f"👤 {self.safe_message(full_name)}{username_display}\n"
+                f"   Класс: {class_name} | ID: {user_id}\n"
+                f"   📅 Зарегистрирован: {reg_date_str}\n\n"
+            )
+            if page_length + len(entry) > MESSAGE_PAGE_LENGTH:
+                self.send_message(chat_id, "".join(page))
+                page = []
+                page_length = 0
+            page.append(entry)
+            page_length += len(entry)
         
-        self.send_message(chat_id, users_text, self.admin_menu_inline_keyboard())
+        self.send_message(chat_id, "".join(page), self.admin_menu_inline_keyboard())
     
     def start_edit_schedule(self, chat_id, username):
-        self.admin_states[username] = {"action": "edit_schedule_class"}
+        self.admin_states[username] = ConversationState("edit_schedule_class")
         self.send_message(
             chat_id,
             "Выберите класс для редактирования расписания:",
@@ -2183,10 +2655,7 @@ class SimpleSchoolBot:
         if username not in self.admin_states:
             return
         
-        self.admin_states[username] = {
-            "action": "edit_schedule_day",
-            "class": class_name
-        }
+        self.admin_states[username] = ConversationState("edit_schedule_day", class_name=class_name)
         
         self.send_message(
             chat_id,
@@ -2202,42 +2671,22 @@ class SimpleSchoolBot:
             self.send_message(chat_id, "❌ Ошибка: действие не найдено", self.admin_menu_inline_keyboard())
             return
         
-        class_name = self.admin_states[username].get("class")
+        class_name = self.admin_states[username].class_name
         if not class_name:
             logger.error(f"Class not found in admin state for {username}")
             self.send_message(chat_id, "❌ Ошибка: класс не выбран", self.admin_menu_inline_keyboard())
             return
         
-        day_map = {
-            "понедельник": "monday",
-            "вторник": "tuesday",
-            "среда": "wednesday",
-            "четверг": "thursday",
-            "пятница": "friday",
-            "суббота": "saturday"
-        }
-        
-        day_code = day_map.get(day_name.lower(), day_name.lower())
+        day_code = DAY_CODES.get(day_name.lower(), day_name.lower())
         
         current_schedule = self.get_schedule(class_name, day_code)
         
         schedule_text = ""
         if current_schedule:
-            schedule_text = "<b>Текущее расписание:</b>\n"
-            for lesson in current_schedule:
-                schedule_text += f"{lesson[0]}. {self.safe_message(lesson[1])}"
-                if lesson[2]:
-                    schedule_text += f" ({self.safe_message(lesson[2])})"
-                if lesson[3]:
-                    schedule_text += f" - {self.safe_message(lesson[3])}"
-                schedule_text += "\n"
-            schedule_text += "\n"
-        
-        self.admin_states[username] = {
-            "action": "edit_schedule_input",
-            "class": class_name,
-            "day": day_code
-        }
+            lessons = "\n".join(self.format_lesson(lesson) for lesson in current_schedule)
+            schedule_text = f"<b>Текущее расписание:</b>\n{lessons}\n\n"
+        
+        self.admin_states[username] = ConversationState("edit_schedule_input", class_name=class_name, day=day_code)
         
         self.send_message(
             chat_id,
@@ -2252,11 +2701,12 @@ class SimpleSchoolBot:
         )
     
     def handle_schedule_input(self, chat_id, username, text):
-        if username not in self.admin_states:
+        state = self.admin_states.get(username)
+        if state is None:
             return
         
-        class_name = self.admin_states[username].get("class")
-        day_code = self.admin_states[username].get("day")
+        class_name = state.class_name
+        day_code = state.day
         
         if not class_name or not day_code:
             self.send_message(chat_id, "❌ Ошибка: данные не найдены", self.admin_menu_inline_keyboard())
@@ -2267,84 +2717,48 @@ class SimpleSchoolBot:
             self.send_message(chat_id, "✅ Расписание очищено!", self.admin_menu_inline_keyboard())
         else:
             lessons = []
-            lines = text.split('\n')
+            add_lesson = lessons.append
             
-            for line in lines:
-                line = line.strip()
-                if not line or not line[0].isdigit():
-                    continue
-                    
-                parts = line.split('.', 1)
-                if len(parts) < 2:
-                    continue
-                    
-                try:
-                    lesson_num = int(parts[0].strip())
-                    lesson_info = parts[1].strip()
-                    
-                    subject = lesson_info
-                    teacher = ""
-                    room = ""
-                    
-                    if '(' in lesson_info and ')' in lesson_info:
-                        start = lesson_info.find('(')
-                        end = lesson_info.find(')')
-                        teacher = lesson_info[start+1:end]
-                        subject = lesson_info[:start].strip()
-                        lesson_info = lesson_info[end+1:].strip()
-                    
-                    if ' - ' in lesson_info:
-                        room_parts = lesson_info.split(' - ', 1)
-                        subject = subject if subject else room_parts[0].strip()
-                        room = room_parts[1].strip()
-                    elif lesson_info and not subject:
-                        subject = lesson_info
-                    
-                    if subject:
-                        lessons.append((lesson_num, subject, teacher, room))
-                except ValueError:
+            for line in text.splitlines():
+                match = LESSON_LINE_RE.match(line)
+                if not match:
                     continue
+                
+                lesson_num = int(match.group(1))
+                lesson_info = match.group(2)
+                
+                subject, teacher, room = parse_lesson_info(lesson_info)
+                if subject:
+                    add_lesson((lesson_num, subject, teacher, room))
             
             self.save_schedule(class_name, day_code, lessons)
             self.send_message(chat_id, f"✅ Расписание для {self.safe_message(class_name)} класса обновлено!", self.admin_menu_inline_keyboard())
         
-        if username in self.admin_states:
-            del self.admin_states[username]
+        self.admin_states.pop(username, None)
     
-    def show_statistics(self, chat_id):
-        users = self.get_all_users()
-        total_users = len(users)
+    def show_statistics(self, chat_id, username=None):
+        classes = self.get_class_counts()
+        total_users = sum(count for _, count in classes)
         
-        classes = {}
-        for user in users:
-            class_name = user[2]
-            if class_name in classes:
-                classes[class_name] += 1
-            else:
-                classes[class_name] = 1
-        
-        stats_text = "📊 <b>Статистика бота</b>\n\n"
-        stats_text += f"👥 Всего пользователей: {total_users}\n\n"
+        parts = ["📊 <b>Статистика бота</b>\n\n", f"👥 Всего пользователей: {total_users}\n\n"]
         
         if classes:
-            stats_text += "<b>Распределение по классам:</b>\n"
-            for class_name, count in sorted(classes.items()):
-                stats_text += f"• {self.safe_message(class_name)}: {count} чел.\n"
+            parts.append("<b>Распределение по классам:</b>\n")
+            parts.extend(f"• {class_name}: {count} чел.\n" for class_name, count in classes)
         
-        self.send_message(chat_id, stats_text, self.admin_menu_inline_keyboard())
+        self.send_message(chat_id, "".join(parts), self.admin_menu_inline_keyboard())
+    
+    def is_duplicate(self, seen, key):
+        with self.dedup_lock:
+            if key in seen:
+                return True
+            
+            seen[key] = None
+            if len(seen) > MAX_PROCESSED_UPDATES:
+                seen.popitem(last=False)
+            return False
     
     def process_update(self, update):
-        update_id = update.get("update_id")
-        
-        if update_id in self.processed_updates:
-            logger.info(f"Пропускаем уже обработанное обновление: {update_id}")
-            return
-        
-        self.processed_updates.add(update_id)
-        
-        if len(self.processed_updates) > 1000:
-            self.processed_updates = set(list(self.processed_updates)[-500:])
-        
         try:
             if "callback_query" in update:
                 self.handle_callback_query(update)
@@ -2353,6 +2767,10 @@ class SimpleSchoolBot:
             if "message" in update:
                 message = update["message"]
                 chat_id = message["chat"]["id"]
+                
+                if self.is_duplicate(self.processed_messages, (chat_id, message.get("message_id"))):
+                    logger.info(f"Пропускаем повторно доставленное сообщение: {message.get('message_id')}")
+                    return
                 user = message.get("from", {})
                 user_id = user.get("id")
                 username = user.get("username", "")
@@ -2362,98 +2780,55 @@ class SimpleSchoolBot:
                     self.send_message(chat_id, "⚠️ Слишком много запросов. Пожалуйста, подождите.")
                     return
                 
-                if "document" in message and username in self.admin_states and self.admin_states[username].get("action") == "waiting_excel":
+                admin_state = self.admin_states.get(username) if self.is_admin(username) else None
+                
+                if "document" in message and admin_state is not None and admin_state.action == "waiting_excel":
                     document = message["document"]
                     file_id = document["file_id"]
                     file_name = document.get("file_name", "")
-                    shift = self.admin_states[username].get("shift", "1")
+                    shift = admin_state.shift or "1"
                     
                     if not file_name.lower().endswith(('.xlsx', '.xls')):
                         self.send_message(chat_id, "❌ Пожалуйста, отправьте файл в формате Excel (.xlsx или .xls)")
                         return
                     
+                    import_state = ConversationState("excel_import", shift=shift)
+                    self.admin_states[username] = import_state
                     self.send_message(chat_id, f"📥 Начинаю загрузку файла для {shift} смены...")
-                    
-                    file_info = self.get_file(file_id)
-                    if not file_info:
-                        self.send_message(chat_id, "❌ Ошибка получения информации о файле")
-                        return
-                    
-                    file_content = self.download_file(file_info["file_path"])
-                    if not file_content:
-                        self.send_message(chat_id, "❌ Ошибка загрузки файла")
-                        return
-                    
-                    self.send_message(chat_id, f"🔍 Обрабатываю расписание для {shift} смены...")
-                    
-                    success, message = self.import_schedule_from_excel(file_content, shift)
-                    
-                    if success:
-                        self.send_message(chat_id, f"✅ {message}", self.admin_menu_inline_keyboard())
-                    else:
-                        self.send_message(chat_id, f"❌ {message}", self.admin_menu_inline_keyboard())
-                    
-                    if username in self.admin_states:
-                        del self.admin_states[username]
+                    self.import_pool.submit(self.run_excel_import, chat_id, username, file_id, import_state)
                     return
                 
                 if "text" in message:
                     text = message["text"]
                     
                     if text == "❌ Отменить":
-                        if username in self.admin_states:
-                            del self.admin_states[username]
-                        if user_id in self.user_states:
-                            del self.user_states[user_id]
+                        self.admin_states.pop(username, None)
+                        self.user_states.pop(user_id, None)
                         self.send_message(chat_id, "Действие отменено", self.main_menu_keyboard())
                         return
                     
-                    if username in self.admin_states:
-                        state = self.admin_states[username]
-                        
-                        if state.get("action") in ["add_class_input", "delete_class_input"]:
-                            self.handle_class_input(chat_id, username, text)
-                            return
-                        
-                        if state.get("action") in ["edit_bell_number", "edit_bell_start", "edit_bell_end"]:
-                            self.handle_bell_input(chat_id, username, text)
-                            return
-                        
-                        if state.get("action") == "delete_user":
-                            self.delete_user_by_identifier(chat_id, username, text)
-                            return
-                        elif state.get("action") == "edit_schedule_input":
-                            self.handle_schedule_input(chat_id, username, text)
-                            return
-                        elif state.get("action") == "edit_schedule_class":
-                            self.handle_schedule_class_selection(chat_id, username, text)
-                            return
-                        elif state.get("action") == "edit_schedule_day":
-                            self.handle_schedule_day_selection(chat_id, username, text)
-                            return
-                        elif state.get("action") == "select_shift":
-                            self.handle_shift_selection(chat_id, username, text)
+                    if admin_state is not None:
+                        action = ADMIN_STATE_ACTIONS.get(admin_state.action)
+                        if action:
+                            getattr(self, action)(chat_id, username, text)
                             return
                     
-                    if user_id in self.user_states:
-                        state = self.user_states[user_id]
-                        if state.get("action") == "registration":
-                            self.handle_registration_input(chat_id, user_id, username, text)
-                            return
+                    user_state = self.user_states.get(user_id)
+                    if user_state is not None and user_state.action == "registration":
+                        self.handle_registration_input(chat_id, user_id, username, text)
+                        return
                     
-                    if text.startswith("/start"):
-                        self.handle_start(chat_id, user)
-                    elif text.startswith("/help"):
-                        self.handle_help(chat_id, username)
-                    elif text.startswith("/admin_panel"):
-                        self.handle_admin_panel(chat_id, username)
-                    elif text in ["📚 Моё расписание", "🏫 Общее расписание", "🔔 Звонки", "📰 Новости", 
-                                "⚙️ Настройки", "🏆 Достижения", "📈 Статистика", "ℹ️ Помощь"]:
+                    command_handler = None
+                    if text[:1] == "/":
+                        command_handler = self.command_handlers.get(text.split(maxsplit=1)[0].partition("@")[0])
+                    
+                    if command_handler:
+                        command_handler(chat_id, user, username)
+                    elif text in MAIN_MENU_ACTIONS:
                         self.handle_main_menu(chat_id, user_id, text, username)
-                    elif text in ["👥 Список пользователей", "❌ Удалить пользователя", "📝 Редактировать расписание", 
-                                  "🏫 Управление классами", "🕧 Управление звонками", "📤 Загрузить Excel", "📊 Статистика", "⬅️ Назад"]:
+                    elif text in ADMIN_MENU_ACTIONS:
                         self.handle_admin_menu(chat_id, username, text)
-                    elif text in ["1 смена", "2 смена"]:
+                    elif text in SHIFT_TEXTS:
                         self.handle_shift_selection(chat_id, username, text)
                     elif text == "⬅️ Назад" or self.is_valid_class(text):
                         self.handle_main_menu(chat_id, user_id, text, username)
@@ -2473,7 +2848,7 @@ class SimpleSchoolBot:
         
         try:
             delete_url = f"{BASE_URL}/deleteWebhook"
-            response = requests.get(delete_url, timeout=10)
+            response = self.session.get(delete_url, timeout=10)
             if response.json().get("ok"):
                 logger.info("Вебхук очищен, используется long polling")
             else:
@@ -2502,16 +2877,26 @@ class SimpleSchoolBot:
                     conflict_count = 0
                 
                 if updates.get("ok") and "result" in updates:
+                    counter_may_reset = time.time() - self.last_update_at >= UPDATE_ID_RESET_AGE
                     for update in updates["result"]:
-                        self.last_update_id = update["update_id"]
-                        self.process_update(update)
+                        update_id = update["update_id"]
+                        if update_id <= self.last_update_id:
+                            if not counter_may_reset:
+                                logger.info(f"Пропускаем уже обработанное обновление: {update_id}")
+                                continue
+                            logger.warning(f"update_id {update_id} не больше сохранённого {self.last_update_id}, счётчик обновлений сброшен")
+                        self.last_update_id = update_id
+                        self.dispatch_update(update)
+                    for update_queue in self.update_queues:
+                        update_queue.join()
+                    if updates["result"]:
+                        self.save_update_offset()
                 else:
                     if "description" in updates:
                         error_desc = updates.get('description', '')
                         if "Conflict" not in error_desc:
                             logger.error(f"Ошибка Telegram API: {error_desc}")
-                
-                time.sleep(0.5)
+                    time.sleep(0.5)
                 
             except Exception as e:
                 logger.error(f"Ошибка в основном цикле: {e}")
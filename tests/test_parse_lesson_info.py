@@ -0,0 +1,22 @@
+import os
+
+import pytest
+
+for module in ("pandas", "numpy", "psycopg2", "requests", "pytz", "schedule"):
+    pytest.importorskip(module)
+
+os.environ.setdefault("BOT_TOKEN", "test-token")
+
+from simple_bot import parse_lesson_info
+
+
+@pytest.mark.parametrize("lesson_info, expected", [
+    ("Физика", ("Физика", "", "")),
+    ("Физика - 101", ("Физика", "", "101")),
+    ("Физика (Иванов)", ("Физика", "Иванов", "")),
+    ("Физика (Иванов) - 101", ("Физика", "Иванов", "101")),
+    ("(Иванов) Физика", ("Физика", "Иванов", "")),
+    ("(Иванов) Физика - 101", ("Физика", "Иванов", "101")),
+])
+def test_parse_lesson_info(lesson_info, expected):
+    assert parse_lesson_info(lesson_info) == expected